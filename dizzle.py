@@ -3,15 +3,420 @@
 """Tools to build DSLs (domain specific languages) with;"""
 
 if True:
+    import bisect
+    import contextlib
+    import functools
+    import itertools
+    import json
+    import mmap
     import os
     import re
     import shlex
     import sys
+    import threading
+    import time
+    from   array import array
+    from   concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+    from   collections import namedtuple, OrderedDict
     from   typing import Any, AnyStr, Dict, List, Match, NoReturn, Pattern
 
 
+class MappedLines():
+    "Read-only line sequence over an mmap'ed file; lines are only decoded (and stripped) when touched;"
+    def __init__(self, fn, encoding='utf-8'):
+        self._fn = fn
+        self._encoding = encoding
+        with open(fn, 'rb') as ifd:
+            size = os.fstat(ifd.fileno()).st_size
+            # ACCESS_READ mappings of the same file share page-cache pages across processes;
+            self._map = mmap.mmap(ifd.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self._offsets = self._index(self._map, size)
+        return
+
+    @staticmethod
+    def _index(buf, size) -> array:
+        "Start offset of every line, plus a final end-of-data sentinel;"
+        offsets = array('Q', [ 0 ])
+        find = buf.find
+        pos = find(b'\n')
+        while pos >= 0:
+            offsets.append(pos + 1)
+            pos = find(b'\n', pos + 1)
+        if offsets[-1] != size:
+            offsets.append(size)
+        return offsets
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [ self[j] for j in range(*i.indices(len(self))) ]
+        if i < 0:
+            i += len(self)
+        if not (0 <= i < len(self)):
+            raise IndexError(f"MappedLines index {i} out of range for {self._fn}")
+        offsets = self._offsets
+        return self._map[offsets[i]:offsets[i + 1]].decode(self._encoding).strip()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+
+    @property
+    def offsets(self):
+        return self._offsets
+
+
+class PieceTable():
+    """Line sequence stored as ( lines, lo, hi ) pieces over shared, never-copied line sequences;
+
+    The pieces are kept as a gap buffer: _left holds the pieces before the gap in order, _right holds the
+    pieces after it as a stack (nearest piece last), each side with running line counts.  Splicing at the
+    gap is O(1), moving the gap costs one step per piece crossed, and indexing is a bisect over pieces.
+    weigh(fn) keeps running totals of fn(piece) as well, so weight_to(where) is a gap move plus a lookup;
+    """
+    def __init__(self, lines = ( )):
+        self._left, self._lend = [ ], [ ]       # Pieces before the gap, running counts from the front;
+        self._right, self._rcum = [ ], [ ]      # Pieces after the gap, running counts from the back;
+        self._weigh, self._lw, self._rw = None, [ ], [ ]    # fn(piece), and its running totals on each side;
+        if len(lines):
+            self._push_right(( lines, 0, len(lines) ))
+        return
+
+    def __eq__(self, other):
+        if isinstance(other, (PieceTable, list, tuple)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [ self[j] for j in range(*i.indices(len(self))) ]
+        n = len(self)
+        if i < 0:
+            i += n
+        if not (0 <= i < n):
+            raise IndexError(f"PieceTable index {i} out of range")
+        nleft = self._lend[-1] if self._lend else 0
+        if i < nleft:
+            k = bisect.bisect_right(self._lend, i)
+            lines, lo, hi = self._left[k]
+            return lines[lo + i - (self._lend[k - 1] if k else 0)]
+        back = n - 1 - i # Distance from the end;
+        k = bisect.bisect_right(self._rcum, back)
+        lines, lo, hi = self._right[k]
+        return lines[hi - 1 - (back - (self._rcum[k - 1] if k else 0))]
+
+    def __iter__(self):
+        for lines, lo, hi in self.pieces:
+            for i in range(lo, hi):
+                yield lines[i]
+
+    def __len__(self):
+        return (self._lend[-1] if self._lend else 0) + (self._rcum[-1] if self._rcum else 0)
+
+    def __str__(self):
+        return "\n".join(self)
+
+    def _push_left(self, piece):
+        self._left.append(piece)
+        self._lend.append((self._lend[-1] if self._lend else 0) + piece[2] - piece[1])
+        if self._weigh is not None:
+            self._lw.append((self._lw[-1] if self._lw else 0) + self._weigh(piece))
+
+    def _push_right(self, piece):
+        self._right.append(piece)
+        self._rcum.append((self._rcum[-1] if self._rcum else 0) + piece[2] - piece[1])
+        if self._weigh is not None:
+            self._rw.append((self._rw[-1] if self._rw else 0) + self._weigh(piece))
+
+    def _pop_left(self):
+        self._lend.pop()
+        if self._weigh is not None:
+            self._lw.pop()
+        return self._left.pop()
+
+    def _pop_right(self):
+        self._rcum.pop()
+        if self._weigh is not None:
+            self._rw.pop()
+        return self._right.pop()
+
+    def weigh(self, fn):
+        "From now on keep running totals of fn(( lines, lo, hi )) per piece (one pass over the pieces now);"
+        self._weigh = fn
+        self._lw = list(itertools.accumulate(fn(piece) for piece in self._left))
+        self._rw = list(itertools.accumulate(fn(piece) for piece in self._right))
+
+    def weight_to(self, where):
+        "Total weight of the lines before position where; moves the gap there;"
+        self._gap_to(where)
+        return self._lw[-1] if self._lw else 0
+
+    @property
+    def weighed(self):
+        return self._weigh is not None
+
+    def _gap_to(self, where):
+        "Move the gap to line position where, splitting a piece if where falls inside one;"
+        while self._lend and self._lend[-1] > where:
+            self._push_right(self._pop_left())
+        nleft = self._lend[-1] if self._lend else 0
+        while self._right and nleft + (self._right[-1][2] - self._right[-1][1]) <= where:
+            self._push_left(self._pop_right())
+            nleft = self._lend[-1]
+        if nleft < where:
+            lines, lo, hi = self._pop_right()
+            cut = lo + where - nleft
+            self._push_left(( lines, lo, cut ))
+            self._push_right(( lines, cut, hi ))
+
+    def add(self, lines, lo = 0, hi = None):
+        "Append lines[lo:hi] by reference;"
+        hi = len(lines) if hi is None else hi
+        self._gap_to(len(self))
+        if hi > lo:
+            self._push_left(( lines, lo, hi ))
+
+    def append(self, ln):
+        self.splice(len(self), [ ln ])
+
+    def pop(self, where = -1):
+        if where < 0:
+            where += len(self)
+        ln = self[where]
+        self.splice(where, ( ), drop=1)
+        return ln
+
+    def splice(self, where, newdata, drop = 0):
+        "Replace drop lines at where with newdata; newdata (or its pieces) is referenced, not copied;"
+        if where < 0 or where > len(self):
+            raise IndexError(f"PieceTable splice position {where} out of range")
+        self._gap_to(where)
+        while drop and self._right:
+            lines, lo, hi = self._pop_right()
+            if hi - lo > drop:
+                self._push_right(( lines, lo + drop, hi ))
+                break
+            drop -= hi - lo
+        if isinstance(newdata, PieceTable):
+            for piece in reversed(newdata.pieces):
+                self._push_right(piece)
+        elif len(newdata):
+            self._push_right(( newdata, 0, len(newdata) ))
+
+    @property
+    def pieces(self):
+        "All ( lines, lo, hi ) pieces, front to back;"
+        return self._left + self._right[::-1]
+
+
+_NOPHASE = contextlib.nullcontext()
+
+
+class Stats():
+    """Opt-in counters and per-phase timers, shareable between Expanders and DynaFiles;
+
+    hook(kind, name, value), if given, is called with every update: kind 'count' with the amount added to
+    counter name, kind 'time' with the seconds a run of phase name took.  snapshot() gives the running totals;
+    """
+    def __init__(self, hook = None, clock = time.perf_counter):
+        self.hook, self.clock = hook, clock
+        self._counts, self._times, self._calls = { }, { }, { }
+        self._lock = threading.Lock()
+        return
+
+    @classmethod
+    def of(cls, stats = None, hook = None):
+        "The Stats a stats=/hook= keyword pair asks for: the Stats passed, a new one for True or a hook, else None;"
+        if isinstance(stats, Stats):
+            return stats
+        return cls(hook) if stats or hook else None
+
+    def count(self, name, n = 1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + n
+        if self.hook is not None:
+            self.hook('count', name, n)
+
+    def time(self, name, seconds):
+        with self._lock:
+            self._times[name] = self._times.get(name, 0.0) + seconds
+            self._calls[name] = self._calls.get(name, 0) + 1
+        if self.hook is not None:
+            self.hook('time', name, seconds)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        "Time the with block as one run of phase name;"
+        began = self.clock()
+        try:
+            yield self
+        finally:
+            self.time(name, self.clock() - began)
+
+    def snapshot(self):
+        "counts, times (seconds) and calls (runs timed) per name, as plain dicts;"
+        with self._lock:
+            return dict(counts=dict(self._counts), times=dict(self._times), calls=dict(self._calls))
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+            self._times.clear()
+            self._calls.clear()
+
+
+class IncludeCycleError(RuntimeError):
+    "An include directive leads back to a file that is already being included;"
+    pass
+
+
+class IncludeCache():
+    "Process-wide cache of trimmed include files, keyed on ( realpath, mtime, size ) and the trim settings;"
+    def __init__(self, maxsize = 512):
+        self._maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+        return
+
+    def load(self, path, owner):
+        "( trimmed lines, directive positions ) for path, trimmed and scanned the way DynaFile owner would;"
+        st = os.stat(path)
+        key = ( path, st.st_mtime_ns, st.st_size, owner._comment, owner._continuation, owner._include_directive )
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        stats = owner._stats
+        if entry is not None:
+            if stats is not None:
+                stats.count('include_cache.hits')
+            return entry
+        with owner._phase('include_read'):
+            with open(path, 'r') as ifd:
+                lines = tuple(owner._trim_lines(owner._join_lines((ln.strip() for ln in ifd), path)))
+        entry = ( lines, owner._directives(lines) )
+        if stats is not None:
+            stats.count('include_cache.misses')
+            stats.count('files')
+            stats.count('bytes', st.st_size)
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class IncludeResolver():
+    """Finds include files along search dirs, caching hits and misses; one is shared by every DynaFile;
+
+    ttl (seconds) expires entries, check_mtime re-validates an entry against the mtimes of the directories
+    its lookup consulted (one stat each instead of a full walk).  Relative names and dirs are resolved
+    against the working directory at lookup time, so call clear() after a chdir;
+    """
+    def __init__(self, ttl = None, check_mtime = False, clock = time.monotonic):
+        self._ttl, self._check_mtime, self._clock = ttl, check_mtime, clock
+        self._entries = { }     # ( fn, search_dirs ) -> ( path or False, realpath, stat calls, expiry, dir mtimes )
+        self._lock = threading.Lock()
+        self.lookups = self.hits = self.negative_hits = self.stat_calls = self.stat_calls_saved = 0
+        return
+
+    def resolve(self, fn, search_dirs, real = False):
+        "fn if it exists, else the first search_dirs match for a bare name, else False; real=True gives the realpath;"
+        key = ( fn, tuple(search_dirs) )
+        entry = self._entries.get(key)
+        with self._lock:
+            self.lookups += 1
+        if entry is not None:
+            nstats = self._validate(entry)
+            if nstats is not False:
+                with self._lock:
+                    self.hits += 1
+                    self.negative_hits += (entry[0] == False)
+                    self.stat_calls += nstats
+                    self.stat_calls_saved += entry[2] - nstats
+                return entry[1] if real and entry[0] else entry[0]
+        entry = self._walk(fn, key[1])
+        with self._lock:
+            self._entries[key] = entry
+            self.stat_calls += entry[2]
+        return entry[1] if real and entry[0] else entry[0]
+
+    def _validate(self, entry):
+        "Number of stat calls spent validating entry, or False if it is stale;"
+        path, realpath, nstats, expiry, mtimes = entry
+        if expiry is not None and self._clock() > expiry:
+            return False
+        if not self._check_mtime:
+            return 0
+        for dirnm, mtime in mtimes:
+            if IncludeResolver._mtime(dirnm) != mtime:
+                return False
+        return len(mtimes)
+
+    @staticmethod
+    def _mtime(dirnm):
+        try:
+            return os.stat(dirnm).st_mtime_ns
+        except OSError:
+            return None
+
+    def _walk(self, fn, search_dirs):
+        "Uncached lookup: ( path or False, realpath, stat calls, expiry, dir mtimes );"
+        nstats, path = 1, False
+        consulted = [ os.path.dirname(fn) or '.' ]
+        if os.path.isfile(fn):
+            path = fn
+        elif '/' not in fn:
+            # No path specified, so search along search_dirs;
+            consulted = [ ]
+            for dirnm in search_dirs:
+                nstats += 1
+                consulted.append(dirnm)
+                candidate = os.path.join(dirnm, fn)
+                if os.path.isfile(candidate):
+                    path = candidate
+                    break
+        realpath = os.path.realpath(path) if path else False
+        expiry = self._clock() + self._ttl if self._ttl is not None else None
+        mtimes = ( )
+        if self._check_mtime:
+            mtimes = tuple(( dirnm, IncludeResolver._mtime(dirnm) ) for dirnm in consulted)
+            nstats += len(mtimes)
+        return ( path, realpath, nstats, expiry, mtimes )
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return dict(lookups=self.lookups, hits=self.hits, negative_hits=self.negative_hits,
+                    stat_calls=self.stat_calls, stat_calls_saved=self.stat_calls_saved, entries=len(self._entries))
+
+
 class DynaFile():
     "Dynamic File processing (expandable) centered around Script/DSL support;"
+    _include_cache = IncludeCache()
+    # Shared for the life of the process, so entries are re-checked against the mtimes of the dirs their lookup
+    # consulted: an include created (or removed) after a lookup is seen, for one stat per dir on a hit;
+    _resolver = IncludeResolver(check_mtime=True)
     def __init__(self, fn, mode='r', **kwa):
         "use __nocomment_ or some other unlikely string if you don't want comment-stripping;"
         self._fn = fn
@@ -21,21 +426,31 @@ class DynaFile():
         default_search_dirs = [ '.', '~', '/etc/dlvdsl' ]
         search_dirs = kwa.get('search_dirs', default_search_dirs)
         self._search_dirs = [os.path.expanduser(dirnm) for dirnm in search_dirs]
+        self._resolver = kwa.get('resolver', DynaFile._resolver)
         self.include = self.insert_raw
         self._trim_line_no = 0
-        # fd = self._open(fn, mode)
-        ifd = open(fn, mode)
+        self._mmap = kwa.get('mmap', False) # mmap implies streaming trim_iter over the mapped lines;
+        self._stream = kwa.get('stream', False) or self._mmap
+        self._encoding = kwa.get('encoding', 'utf-8')
+        # e.g. include_directive='include': splice (nested) "include <file>" lines in as the file is read;
+        self._include_directive = kwa.get('include_directive', None)
+        # prefetch=True (or a worker count) loads the whole include tree in a thread pool before splicing;
+        self._prefetch = kwa.get('prefetch', False)
+        # stats=True (or a shared Stats) counts and times loading, hook=fn sees each update, see README (Stats);
+        self._stats = Stats.of(kwa.get('stats', None), kwa.get('hook', None))
         if mode == 'r':
             self._read_file(fn)
             return
         if mode in [ 'w', 'a' ]:
+            with open(fn, mode):
+                pass
             self._obuf = [ ]
             return
         raise ValueError(f"Illegal IO mode {mode}")
 
     def __getitem__(self, i):
         if self._mode == 'r':
-            return self._ibuf[i]
+            return self._raw()[i]
         if self._mode in [ 'w', 'a' ]:
             return self._obuf[i]
         raise ValueError(f"Illegal IO mode {mode}")
@@ -49,19 +464,36 @@ class DynaFile():
 
     def __len__(self):
         if self._mode == 'r':
-            return len(self._ibuf)
+            return len(self._raw())
         if self._mode in [ 'w', 'a' ]:
             return len(self._obuf)
 
     def __str__(self):
         if self._mode == 'r':
-            return "\n".join(self._ibuf)
+            return "\n".join(self._raw())
         if self._mode in [ 'w', 'a']:
             return "\n".join(self._obuf)
 
+    def _raw(self):
+        if self._ibuf is None:
+            raise RuntimeError(f"Raw lines aren't kept for a streaming DynaFile ({self._fn})")
+        return self._ibuf
+
+    def close(self):
+        "Release the mapping of an mmap'ed DynaFile;"
+        if self._mmap:
+            self._ibuf.close()
+
+    def stats(self):
+        "Snapshot of the counters and phase times (see Stats), or None if stats weren't asked for;"
+        return self._stats.snapshot() if self._stats is not None else None
+
+    def _phase(self, name):
+        return self._stats.phase(name) if self._stats is not None else _NOPHASE
+
     def append(self, txt):
         if self._mode == 'r':
-            self._ibuf.append()
+            self.insert_raw(len(self), [ txt ])
             return txt
         if self._mode in ['w', 'a']:
             self._obuf.append(txt)
@@ -69,117 +501,331 @@ class DynaFile():
         raise ValueError(f"Illegal IO mode {self._mode}")
 
     def insert_raw(self, where, newdata):
-        if self._mode == 'r':
-            buf = self._ibuf
-        elif self._mode in [ 'w', 'a' ]:
-            buf = self._obuf
-        else:
-            raise ValueError(f"Illegal IO mode {self._mode}")
-        processed = buf[:where]
-        unprocessed = buf[where:]
+        """Splice raw lines in at where; only newdata gets trimmed, into the matching place in trimmed;
+
+        Nothing around where is re-trimmed: lines inserted between a continued line and the line it continues
+        onto go in ahead of the joined line, they aren't joined with it the way trimming the whole file would;
+        """
         # Don't move self._line_no during this process, ibuf should only grow;
-        if self._mode == 'a':
-            self._ibuf = processed + newdata + unprocessed
-            self._trimmed = self.trim(self._ibuf)
-        else:
-            self._obuf = processed + newdata + unprocessed
-            self._trimmed = self.trim(self._obuf)
+        if self._mode in [ 'w', 'a' ]:
+            self._obuf[where:where] = newdata
+            return self._line_no
+        if self._mode != 'r':
+            raise ValueError(f"Illegal IO mode {self._mode}")
+        if self._mmap:
+            raise RuntimeError(f"An mmap'ed DynaFile is read-only, can't insert_raw into {self._fn}")
+        newdata = list(newdata)
+        raw = self._raw()
+        if not raw.weighed:
+            raw.weigh(self._trimmed_weight) # Lazily: a DynaFile nobody inserts into never counts;
+        trimmed_where = raw.weight_to(where)
+        raw.splice(where, newdata)          # The gap is already at where;
+        self._trimmed.splice(trimmed_where, self.trim(newdata))
         return self._line_no
 
+    def _trimmed_weight(self, piece):
+        "Number of trimmed lines a raw ( lines, lo, hi ) piece produces, via per-source trim counts;"
+        lines, lo, hi = piece
+        source, counts = self._trim_counts.get(id(lines), ( None, None ))
+        if source is not lines:
+            spliced = self._spliced[1] if lines is self._spliced[0] else None
+            counts = self._count_trimmed(lines, spliced)
+            self._trim_counts[id(lines)] = ( lines, counts )
+        return counts[hi] - counts[lo]
+
+    def _count_trimmed(self, raw, spliced = None):
+        """counts[j] is the number of trimmed lines raw[:j] produces (continuations count where they end);
+
+        spliced maps trimmed line numbers of include directives to the lines their include added;
+        """
+        at = [ 0 ]
+        def tracked():
+            for j, ln in enumerate(raw):
+                at[0] = j + 1
+                yield ln
+        counts = array('l', [ 0 ]) * (len(raw) + 1)
+        for k, ln in enumerate(self._trim_lines(self._join_lines(tracked()))):
+            counts[at[0]] += 1 + (spliced.get(k, 0) if spliced else 0)
+        for j in range(1, len(counts)):
+            counts[j] += counts[j - 1]
+        return counts
+
     def insert_trimmed(self, newdata, where = None, **kwa):
         drop = kwa.get('exclude_source_lines', 1)
         if where == None:
             where = self.trim_line_no
-        processed = self.trimmed[:where]
-        unprocessed = self.trimmed[where + drop:]
-        self._trimmed = processed + newdata + unprocessed
+        if self._stream:
+            self._splice_stream(newdata, where, drop)
+            return
+        self._trimmed.splice(where, newdata, drop)
+        self._trim_line_no = where - 1 # The yield will skip the first included line w/o this;
+
+    def _splice_stream(self, newdata, where, drop):
+        "Streaming insert_trimmed: newdata is read next, the current line counts as the first dropped line;"
+        if where != self.trim_line_no:
+            raise ValueError(f"A streaming DynaFile can only insert at the current line ({self.trim_line_no}), not {where}")
+        for n in range(drop - 1):
+            self._pull()
+        if drop == 0 and self._current is not None:
+            self._pending.append(( iter([ self._current ]), None ))
+        self._pending.append(( iter(newdata), None ))
         self._trim_line_no = where - 1 # The yield will skip the first included line w/o this;
 
     def _open(self, fn, mode):
         if mode == 'r':
-            if not os.path.isfile(fn):
-                if '/' in fn:
-                    # Path specified, shouldn't search along search_dirs;
-                    return False
-                fn = self._search(fn)
-                if fn == False:
-                    return False
+            fn = self._search(fn)
+            if fn == False:
+                return False
             fd = open(fn, mode)
             return fd
         return True # Always true for other modes...until rb is implemented;
 
+    def _search(self, fn, real = False):
+        "fn itself, or the first search_dirs match for a bare file name, or False (cached by the resolver);"
+        return self._resolver.resolve(fn, self._search_dirs, real)
+
+    def _directives(self, lines):
+        "Positions of the include directive lines in lines;"
+        directive = self._include_directive
+        if not directive:
+            return ( )
+        return tuple(i for i, ln in enumerate(lines) if ln.split(None, 1)[0].lower() == directive)
+
+    def _resolve_include(self, ln, including, counter = 'includes'):
+        "realpath of the file an include line names; counter is the stats counter it counts towards;"
+        tokens = ln.split()
+        if len(tokens) < 2:
+            raise ValueError(f"{self._include_directive} without a file name in {including}")
+        fn = tokens[1].strip("\"'")
+        path = self._search(fn, real=True)
+        if path == False:
+            raise FileNotFoundError(f"Can't find {fn} (included from {including}) in {self._search_dirs}")
+        if self._stats is not None:
+            self._stats.count(counter)
+        return path
+
+    def _include_tree(self, fn, lines):
+        "Splice every include (recursively) into one PieceTable that shares the cached trimmed lines;"
+        root = os.path.realpath(fn)
+        table, files = self._expand_includes(root, lines, self._directives(lines), [ root ], { }, self._spliced[1])
+        return table
+
+    def _expand_includes(self, path, lines, directives, chain, built, spliced = None):
+        """( PieceTable, set of files in it ) for lines; built memoizes each included file for this load;
+
+        spliced, if given, maps the position of each include directive in lines to the lines its include added;
+        """
+        table, files = PieceTable(), { path }
+        start = 0
+        for i in directives:
+            table.add(lines, start, i)
+            start = i + 1
+            child = self._resolve_include(lines[i], path)
+            if child in chain:
+                raise IncludeCycleError(f"Include cycle: {' -> '.join(chain + [ child ])}")
+            if child not in built:
+                clines, cdirectives = DynaFile._include_cache.load(child, self)
+                built[child] = self._expand_includes(child, clines, cdirectives, chain + [ child ], built)
+            subtable, subfiles = built[child]
+            if not subfiles.isdisjoint(chain):
+                raise IncludeCycleError(f"Include cycle: {' -> '.join(chain + [ child ])} includes one of {chain}")
+            table.splice(len(table), subtable)
+            files |= subfiles
+            if spliced is not None:
+                spliced[i] = len(subtable) - 1
+        table.add(lines, start, len(lines))
+        return table, files
+
+    def prefetch_includes(self, lines, max_workers = None):
+        """Read and trim every file in the include tree under lines into the include cache, in a thread pool;
+
+        Splicing still happens in order afterwards, as cache hits.  Files that fail to resolve or load are
+        skipped here, the in-order pass reports them where they occur;
+        """
+        if max_workers is None and self._prefetch is not True:
+            max_workers = self._prefetch or None
+        root = os.path.realpath(self._fn)
+        seen, futures = { root }, { }
+        with ThreadPoolExecutor(max_workers) as pool:
+            def submit(including, lines, directives):
+                for i in directives:
+                    try:
+                        child = self._resolve_include(lines[i], including, 'prefetch.includes')
+                    except (OSError, ValueError):
+                        continue
+                    if child not in seen:
+                        seen.add(child)
+                        futures[pool.submit(DynaFile._include_cache.load, child, self)] = child
+            submit(root, lines, self._directives(lines))
+            while futures:
+                done, not_done = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    child = futures.pop(future)
+                    if future.exception() is None:
+                        clines, cdirectives = future.result()
+                        submit(child, clines, cdirectives)
+        return len(seen) - 1
+
     def pop_trimmed(self, where = 0):
         self._trimmed.pop(where)
 
     def _read_file(self, fn):
-        ifd = open(fn, 'r')
-        self._ibuf = [ln.strip() for ln in ifd.readlines()]
-        ifd.close()
-        self._all_data = [ ]
         self._line_no = 0
-        nlines = len(self._ibuf)
-        i = 0
-        while i < nlines:
-            ln = self._ibuf[i]
-            if self._continuation:
-                if ln.endswith(self._continuation):
-                    done = False
-                    offset = 1
-                    while not done:
-                        if i + offset >= nlines:
-                            raise EOFError(f"Continuation symbol appears immediately before EOF in {fn}")
-                        ln = ln[:-len(self._continuation)] # Strip off the continuation character;
-                        ln = ln + self._ibuf[i + offset]
-                        offset += 1
-                        if not ln.endswith(self._continuation):
-                            done = True
-                            continue
-                    i = i + offset - 1
-            i += 1
-            self._all_data.append(( i, ln ))
-        self._trimmed = self.trim(self._ibuf)
+        if self._stream:
+            # Nothing is buffered up front, trim_iter pulls lines through the pipeline on demand;
+            self._ibuf = MappedLines(fn, self._encoding) if self._mmap else None
+            if self._mmap and self._stats is not None:
+                self._stats.count('files')
+                self._stats.count('lines', len(self._ibuf))
+                self._stats.count('bytes', self._ibuf.offsets[-1])
+            self._trimmed = None
+            self._current = None
+            lines = iter(self._ibuf) if self._mmap else self._stream_lines(fn)
+            if self._include_directive and self._prefetch:
+                # A separate pass that only keeps the directive lines, so memory stays bounded;
+                rescan = iter(self._ibuf) if self._mmap else self._stream_lines(fn)
+                directive_lines = tuple(ln for ln in self._trim_lines(self._join_lines(rescan, fn))
+                                        if self._directives(( ln, )))
+                with self._phase('prefetch'):
+                    self.prefetch_includes(directive_lines)
+            self._pending = [ ( self._trim_lines(self._join_lines(lines, fn)), os.path.realpath(fn) ) ]
+            return
+        with self._phase('read'):
+            with open(fn, 'r') as ifd:
+                ibuf = [ln.strip() for ln in ifd]
+                size = os.fstat(ifd.fileno()).st_size
+        self._ibuf = PieceTable(ibuf)
+        self._spliced = ( ibuf, { } )   # The raw lines, { trimmed position: lines added } per include spliced in;
+        with self._phase('trim'):
+            trimmed = self.trim(ibuf)
+        if self._stats is not None:
+            self._stats.count('files')
+            self._stats.count('lines', len(ibuf))
+            self._stats.count('bytes', size)
+        if self._include_directive and self._prefetch:
+            with self._phase('prefetch'):
+                self.prefetch_includes(trimmed)
+        if self._include_directive:
+            with self._phase('includes'):
+                self._trimmed = self._include_tree(fn, trimmed)
+        else:
+            self._trimmed = PieceTable(trimmed)
+        self._trim_counts = { } # id(raw source) -> ( source, array of trimmed line counts ), built by insert_raw;
+
+    def _stream_lines(self, fn):
+        "Generator stage: stripped raw lines, read lazily; the file is closed once exhausted;"
+        with open(fn, 'r') as ifd:
+            if self._stats is None:
+                for ln in ifd:
+                    yield ln.strip()
+                return
+            nlines = 0
+            for ln in ifd:
+                nlines += 1
+                yield ln.strip()
+            self._stats.count('files')
+            self._stats.count('lines', nlines)
+            self._stats.count('bytes', os.fstat(ifd.fileno()).st_size)
+
+    def _join_lines(self, lines, fn = None):
+        "Generator stage: fold continued lines into one;"
+        continuation = self._continuation
+        if not continuation:
+            yield from lines
+            return
+        clen = len(continuation)
+        joined = None
+        for ln in lines:
+            if joined is not None:
+                ln = joined + ln
+                joined = None
+            if ln.endswith(continuation):
+                joined = ln[:-clen] # Strip off the continuation character;
+                continue
+            yield ln
+        if joined is not None:
+            raise EOFError(f"Continuation symbol appears immediately before EOF in {fn or self._fn}")
+
+    def _trim_lines(self, lines):
+        "Generator stage: strip comments, drop blank and comment-only lines;"
+        comment = self._comment
+        for ln in lines:
+            if not ln:
+                continue
+            if ln.startswith(comment):
+                continue
+            if comment in ln:
+                ln = ln[:ln.index(comment)]
+            ln = ln.strip()
+            if ln:
+                yield ln
+
+    def _pull(self):
+        "Next trimmed line from the innermost pending source, None at EOF;"
+        pending = self._pending
+        while pending:
+            for ln in pending[-1][0]:
+                return ln
+            pending.pop()
+        return None
+
+    def _next_streamed(self):
+        "Like _pull, but include directives are replaced by (pushing) the included file;"
+        ln = self._pull()
+        directive = self._include_directive
+        while directive and ln is not None and ln.split(None, 1)[0].lower() == directive:
+            chain = [ path for source, path in self._pending if path ]
+            child = self._resolve_include(ln, chain[-1] if chain else self._fn)
+            if child in chain:
+                raise IncludeCycleError(f"Include cycle: {' -> '.join(chain + [ child ])}")
+            lines, directives = DynaFile._include_cache.load(child, self)
+            self._pending.append(( iter(lines), child ))
+            ln = self._pull()
+        return ln
 
     def save(self, fn = None):
         if not fn:
             fn = self._fn
         if self._mode == 'r':
             # This is a essentially copy command
-            self._obuf = self._ibuf[:]
+            self._obuf = self._raw()[:]
         ofd = open(fn, self._mode)
         ostr = str(self)
         ofd.write(ostr + '\n')
 
     def trim(self, ibuf):
-        # Replace with dataflow generator approach (cf. mcoding:python generators)?
-        trim = [ ]
-        ibuf = filter(None, ibuf) # Remove blank lines;
-        for ln in ibuf:
-            if ln.startswith(self._comment):
-                continue
-            if self._comment in ln:
-                start = ln.index(self._comment)
-                ln = ln[:start].strip()
-                trim.append(ln)
-                continue
-            trim.append(ln.strip())
-        ibuf = filter(None, ibuf) # Remove blank lines that resulted from <spaces><comment>stuff;
-        return trim
+        "Join continuations, strip comments and drop blank lines from a list of raw lines;"
+        return list(self._trim_lines(self._join_lines(ibuf)))
 
     def trim_iter(self):
+        if self._stream:
+            yield from self._trim_iter_stream()
+            return
         while self._trim_line_no < len(self.trimmed):
             yield self.trimmed[self._trim_line_no]
             self._trim_line_no += 1
 
+    def _trim_iter_stream(self):
+        while True:
+            ln = self._next_streamed()
+            if ln is None:
+                return
+            self._current = ln
+            yield ln
+            self._trim_line_no += 1
+
     @property
     def all(self):
         if self._mode == 'r':
-            return self._ibuf
+            return self._raw()
         if self._mode in [ 'w', 'a' ]:
             return self._obuf
         raise ValueError(f"Illegal IO mode {self._mode}")
 
     @property
     def current_text(self):
+        if self._stream:
+            return self._current # The line trim_iter is on, mmap'ed or not;
         if self._mode == 'r':
             return self._ibuf[self.index]
         if self._mode in [ 'w', 'a' ]:
@@ -192,8 +838,17 @@ class DynaFile():
 
     @property
     def trimmed(self):
+        if self._stream:
+            # Streaming keeps no buffer, so this is only the not-yet-read lines (and reads them all);
+            remaining = [ ]
+            ln = self._next_streamed()
+            while ln is not None:
+                remaining.append(ln)
+                ln = self._next_streamed()
+            self._pending = [ ( iter(remaining), None ) ]
+            return remaining
         return self._trimmed
-    
+
     @property
     def trim_line_no(self):
         return self._trim_line_no
@@ -204,10 +859,9 @@ class DynaFile():
 
 
 class VarHelper():
+    "Regexes for one reference syntax; stateless (match and findall return their results) so it can be shared;"
     def __init__(self, name: AnyStr, base_pattern: AnyStr, start: AnyStr = "{", end: AnyStr = "}") -> NoReturn:
         self._name = name
-        self._groupdict = dict()
-        self._groups = [ ]
         # self._dict = dict(matcher=None, matched=None, varname=None, value=None, full=None, core=None)
         self._base = base_pattern
         # print("base", base_pattern)
@@ -223,31 +877,16 @@ class VarHelper():
         self._core = self._full = None
         return
 
-    def __contains__(self, k):
-        return k in self._groupdict
-
-    def __getitem__(self, k):
-        if type(k) == type(0):
-            return self._groups[k]
-        if type(k) == type(""):
-            return self._groupdict[k]
-
     def __str__(self):
         return f"{self._name}: {str(self._full)}"
 
     def findall(self, token: AnyStr) -> List:
         """Uses the full pattern (includes delimiters) to find all matches in token;"""
-        matches = self._full_rex.findall(token) # findall returns a list of tuples of matches
-        self._matches = [ mtch for mtch in matches ] # Prune it to lists of [ full, core ], for easy replace operations;
-        return self._matches
+        return self._full_rex.findall(token) # findall returns a list of tuples of [ full, core, ... ] matches
 
     def match(self, token: AnyStr) -> Match[str]:
         """Uses the core pattern to extract ONLY the variable name"""
-        mtch = self._core_rex.match(token)
-        if mtch:
-            self._groupdict = mtch.groupdict()
-            self._groups = mtch.groups()
-        return mtch
+        return self._core_rex.match(token)
 
     @property
     def base(self):
@@ -262,47 +901,510 @@ class VarHelper():
         return self._full
 
     @property
-    def groupdict(self):
-        return self._groupdict
-        
+    def name(self):
+        return self._name
+
+
+# A parsed {...} reference; name is core without any leading ~, ns/var/field are None where they don't apply,
+# spec is the format spec after the reference ({frame:04d}), only scanned for by typed rendering;
+VarRef = namedtuple('VarRef', [ 'full', 'name', 'kind', 'ns', 'var', 'field', 'getlen', 'spec' ], defaults=( None, ))
+
+TEMPLATE_CACHE_SIZE = 1024
+
+
+class Template():
+    "Compiled expand() text: literal parts with VarRef slots, so a re-render only does the lookups;"
+    def __init__(self, text: AnyStr, parts: List, slots: List, ntokens: int = 0) -> NoReturn:
+        self._text = text
+        self._parts = tuple(parts)  # Literal strings, with None wherever a reference's value goes;
+        self._slots = tuple(slots)  # ( index into parts, VarRef ) pairs;
+        self._ntokens = ntokens     # Tokens text was split into when compiled (0 for values, which aren't);
+        return
+
+    def __str__(self):
+        return self._text
+
+    def render(self, xp, view = None, memo = None, budget = None) -> str:
+        "Fill in every slot by dereferencing its VarRef against Expander xp (memo, budget: see Expander._expand_value);"
+        if not self._slots:
+            return "".join(self._parts)
+        parts = list(self._parts)
+        resolve, view = xp._resolve_ref, view or xp._view()
+        memo = { } if memo is None else memo
+        if budget is not None:
+            length = sum(len(part) for part in parts if part)
+            for i, ref in self._slots:
+                parts[i] = resolve(ref, view, memo, budget)
+                length += len(parts[i])
+                budget.charge(ref.name, length)
+            return "".join(parts)
+        for i, ref in self._slots:
+            parts[i] = resolve(ref, view, memo)
+        return "".join(parts)
+
+    def render_typed(self, xp, budget = None):
+        "Like render, but values stay native until formatted into the output; a lone reference gives its value itself;"
+        view, memo = xp._view(), { }
+        if len(self._parts) == 3 and not self._parts[0] and not self._parts[2]:
+            ref = self._slots[0][1]
+            value, spec = xp._typed_ref(ref, view, memo, budget)
+            if value is _UNSET:
+                return ref.full
+            return value if spec is None else _format_ref(ref, value, spec)
+        parts = list(self._parts)
+        length = sum(len(part) for part in parts if part)
+        for i, ref in self._slots:
+            value, spec = xp._typed_ref(ref, view, memo, budget)
+            parts[i] = ref.full if value is _UNSET else _format_ref(ref, value, spec or "")
+            if budget is not None:
+                length += len(parts[i])
+                budget.charge(ref.name, length)
+        return "".join(parts)
+
     @property
-    def groups(self):
-        return self._groups
+    def slots(self):
+        return self._slots
 
     @property
-    def matches(self):
-        return self._matches
+    def refs(self):
+        return [ ref for i, ref in self._slots ]
 
     @property
-    def name(self):
-        return self._name
-    
+    def text(self):
+        return self._text
+
+    @property
+    def ntokens(self):
+        return self._ntokens
+
+
+# All four reference syntaxes as one alternation, tried DEEP, NAMESPACED, FIELDED, then SIMPLE;
+REF_CORE_PATTERN = (r'(?P<getlen>\~)?(?:(?P<deep_ns>\w+):(?P<deep_var>\w+)\.(?P<deep_field>\w+)'
+                    r'|(?P<ns_ns>\w+):(?P<ns_var>\w+)|(?P<f_var>\w+)\.(?P<f_field>\w+)|(?P<s_var>\w+))')
+
+
+class VarScanner():
+    "Finds and classifies every delimited reference in a single left-to-right regex pass;"
+    REF_CACHE_SIZE = 4096
+
+    def __init__(self, start: AnyStr = "{", end: AnyStr = "}", specs: bool = False) -> NoReturn:
+        self._start, self._end = start, end
+        self._refs = { }
+        spec = r'(?::(?P<spec>.*?))?' if specs else ''
+        pattern = rf'{re.escape(start)}\s*(?P<core>{REF_CORE_PATTERN}){spec}\s*{re.escape(end)}'
+        self._rex = re.compile(pattern)
+        return
+
+    @staticmethod
+    def to_ref(full: AnyStr, mtch: Match) -> VarRef:
+        "Build the VarRef for a REF_CORE_PATTERN match;"
+        getlen, dns, dvar, dfield, nns, nvar, fvar, ffield, svar = mtch.group(
+            'getlen', 'deep_ns', 'deep_var', 'deep_field', 'ns_ns', 'ns_var', 'f_var', 'f_field', 's_var')
+        name = mtch.group('core')
+        spec = mtch.group('spec') if 'spec' in mtch.re.groupindex else None
+        if getlen:
+            name = name[1:]
+        if dvar is not None:
+            return VarRef(full, name, 'deep', dns, dvar, dfield, bool(getlen), spec)
+        if nvar is not None:
+            return VarRef(full, name, 'namespaced', nns, nvar, None, bool(getlen), spec)
+        if fvar is not None:
+            return VarRef(full, name, 'fielded', 'default', fvar, ffield, bool(getlen), spec)
+        return VarRef(full, name, 'simple', 'default', svar, None, bool(getlen), spec)
+
+    def ref(self, mtch: Match) -> VarRef:
+        "VarRef for a match, shared across matches of the same reference text;"
+        full = mtch.group(0)
+        ref = self._refs.get(full)
+        if ref is None:
+            if len(self._refs) >= VarScanner.REF_CACHE_SIZE:
+                self._refs.clear()
+            ref = self._refs[full] = VarScanner.to_ref(full, mtch)
+        return ref
+
+    def scan(self, text: AnyStr):
+        "Yield ( literal, VarRef ) pairs in order; the final pair carries the trailing literal and None;"
+        pos = 0
+        for mtch in self._rex.finditer(text):
+            yield text[pos:mtch.start()], self.ref(mtch)
+            pos = mtch.end()
+        yield text[pos:], None
+
+    def substitute(self, text: AnyStr, resolve) -> str:
+        "Replace each reference with resolve(VarRef), building the output with one join;"
+        olist, pos = [ ], 0
+        values = { }    # Repeated references are only resolved once per call;
+        for mtch in self._rex.finditer(text):
+            olist.append(text[pos:mtch.start()])
+            full = mtch.group(0)
+            v = values.get(full)
+            if v is None:
+                v = values[full] = resolve(self.ref(mtch))
+            olist.append(v)
+            pos = mtch.end()
+        if not olist:
+            return text
+        olist.append(text[pos:])
+        return "".join(olist)
+
+    @property
+    def pattern(self):
+        return self._rex.pattern
+
+
+KEY_CACHE_SIZE = 8192
+_CORE_REX = re.compile(rf'(?P<core>{REF_CORE_PATTERN})')
+
+
+@functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+def _parse_key(k: AnyStr) -> VarRef:
+    "Classify a key once; repeat lookups of the same key string skip the regex entirely;"
+    mtch = _CORE_REX.fullmatch(k)
+    if not mtch:
+        if '.' not in k and ':' not in k and not k.startswith("~"):
+            # No separators: a plain default-namespace name, whatever characters it has (eg: a-b, "x y");
+            return VarRef(k, k, 'simple', 'default', k, None, False)
+        raise IndexError(f"Expander.parse_key: Couldn't parse {k} as a variable name")
+    return VarScanner.to_ref(k, mtch)
+
+
+@functools.lru_cache(maxsize=None)
+def _scanner(start: AnyStr, end: AnyStr, specs: bool = False) -> VarScanner:
+    return VarScanner(start, end, specs)
+
+
+SPEC_CACHE_SIZE = 512
+# Python's format spec mini-language: [[fill]align][sign][z][#][0][width][grouping][.precision][type];
+_SPEC_REX = re.compile(r'(?:.?[<>=^])?[-+ ]?z?#?0?\d*[_,]?(?:\.\d+)?(?P<type>[bcdeEfFgGnosxX%])?', re.S)
+_SPEC_TYPES = dict(b=int, c=int, d=int, o=int, x=int, X=int, e=float, E=float, f=float, F=float,
+                   g=float, G=float, n=float, **{ '%': float })
+
+
+@functools.lru_cache(maxsize=SPEC_CACHE_SIZE)
+def _parse_spec(spec: AnyStr):
+    "( type a str value is converted to first, or None; spec ), validated once per distinct spec;"
+    mtch = _SPEC_REX.fullmatch(spec)
+    if not mtch:
+        raise ValueError(f"Expander: Bad format spec {spec}")
+    return _SPEC_TYPES.get(mtch.group('type')), spec
+
+
+def _format_value(value, spec: AnyStr) -> str:
+    "format(value, spec), converting str values to the number type spec asks for; other specs go to the value's __format__;"
+    try:
+        type_, spec = _parse_spec(spec)
+    except ValueError:
+        if isinstance(value, str):
+            raise
+        return format(value, spec) # eg: %Y-%m-%d for a date;
+
+    if type_ is not None and isinstance(value, str):
+        value = type_(value)
+    return format(value, spec)
+
+
+def _format_ref(ref: VarRef, value, spec: AnyStr) -> str:
+    "value formatted by spec, or, like an unknown reference, ref as written when it can't be (eg: {host:x});"
+    try:
+        return _format_value(value, spec)
+    except (ValueError, TypeError):
+        return ref.full
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _compile_value(text: AnyStr, start: AnyStr, end: AnyStr) -> Template:
+    "A variable's value as a Template: scanned for references as-is, no tokenizing (so quotes are kept);"
+    parts, slots = [ ], [ ]
+    for piece, ref in _scanner(start, end).scan(text):
+        parts.append(piece)
+        if ref is not None:
+            slots.append(( len(parts), ref ))
+            parts.append(None)
+    return Template(text, parts, slots)
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _compile_template(text: AnyStr, start: AnyStr, end: AnyStr, tokenizer = None, specs = False) -> Template:
+    "Tokenize text once and locate its references; cached on ( text, start, end, tokenizer, specs );"
+    scanner = _scanner(start, end, specs)
+    parts, slots = [ ], [ ]
+    literal = [ ]
+    tokens = list(Expander.tokenize_static(text, tokenizer=tokenizer))
+    for n, token in enumerate(tokens):
+        if n:
+            literal.append(" ")
+        if not Expander.expandable_static(token, start, end):
+            literal.append(token)
+            continue
+        for piece, ref in scanner.scan(token):
+            literal.append(piece)
+            if ref is None:
+                continue
+            parts.append("".join(literal))
+            literal = [ ]
+            slots.append(( len(parts), ref ))
+            parts.append(None)
+    parts.append("".join(literal))
+    return Template(text, parts, slots, len(tokens))
+
+
+_STAMPS = itertools.count(1)
+_NOLOCK = contextlib.nullcontext()
+_UNSET = object()
+
+
+class ExpansionCycleError(RuntimeError):
+    "A variable's value refers, directly or through other variables, back to itself;"
+    pass
+
+
+# Bounds on one expand() (or Fixer call), None for no bound; time_budget is in seconds;
+ExpansionLimits = namedtuple('ExpansionLimits', [ 'max_output', 'max_substitutions', 'max_depth', 'time_budget' ],
+                             defaults=( None, None, None, None ))
+
+
+class ExpansionLimitError(RuntimeError):
+    "An expansion went over one of its ExpansionLimits; .limit says which, .name is the variable being expanded;"
+    def __init__(self, where, limit, bound, name):
+        self.limit, self.bound, self.name = limit, bound, name
+        super().__init__(f"{where}: expanding {name} went over {limit}={bound}")
+
+
+class Budget():
+    "What one expansion has left of its ExpansionLimits;"
+    __slots__ = ( 'limits', 'where', 'substitutions', 'deadline' )
+
+    def __init__(self, limits, where):
+        self.limits, self.where = limits, where
+        self.substitutions = 0
+        self.deadline = None if limits.time_budget is None else time.monotonic() + limits.time_budget
+
+    def charge(self, name, length, depth = 0, count = 1):
+        "Account for count substitutions made while expanding name, which is now length long and depth levels down;"
+        limits = self.limits
+        self.substitutions += count
+        if limits.max_substitutions is not None and self.substitutions > limits.max_substitutions:
+            self.exceeded('max_substitutions', name)
+        if limits.max_output is not None and length > limits.max_output:
+            self.exceeded('max_output', name)
+        if limits.max_depth is not None and depth > limits.max_depth:
+            self.exceeded('max_depth', name)
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            self.exceeded('time_budget', name)
+
+    def exceeded(self, limit, name) -> NoReturn:
+        raise ExpansionLimitError(self.where, limit, getattr(self.limits, limit), name)
+
+
+class Stamps():
+    "Change stamps: version moves on every change, of[key] on changes to one scope (by id) or namespace (by name);"
+    __slots__ = ( 'version', 'of' )
+
+    def __init__(self):
+        self.version = next(_STAMPS)
+        self.of = { }
+
+    def bump(self, key):
+        # Stamps come from one process-wide counter, so a stamp is never reused, even by another key;
+        self.version = self.of[key] = next(_STAMPS)
+
+
+class OutputCache():
+    """Bounded LRU of rendered outputs, each valid while the stamps of whatever it read are unchanged;
+
+    Renders from several threads share one cache even without threadsafe=True, so it locks for itself;
+    """
+    def __init__(self, maxsize = 256):
+        self._maxsize = maxsize
+        self._entries = OrderedDict()   # text -> ( deps, what the render read, output )
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.invalidations = 0
+        return
+
+    def get(self, text, deps_of):
+        "Cached output for text if deps_of(reads) still matches what it was rendered against, else None;"
+        with self._lock:
+            entry = self._entries.get(text)
+            if entry is None:
+                self.misses += 1
+                return None
+            deps, reads, output = entry
+            if deps_of(reads) != deps:
+                del self._entries[text]
+                self.misses += 1
+                self.invalidations += 1
+                return None
+            self._entries.move_to_end(text)
+            self.hits += 1
+            return output
+
+    def put(self, text, deps, reads, output):
+        with self._lock:
+            self._entries[text] = ( deps, reads, output )
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def info(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, invalidations=self.invalidations,
+                        entries=len(self._entries), maxsize=self._maxsize)
+
+
+class Provider():
+    """A namespace that looks values up on demand instead of holding them all: Provider(fn), with fn(var)
+    giving var's value (or raising KeyError), or a subclass overriding load(var, field);
+
+    memoize keeps what load() returns, per ( var, field ), for ttl seconds (None: until invalidate()).
+    Values set through the Expander are kept here and win over load();
+    """
+    def __init__(self, fn = None, memoize = True, ttl = None, clock = time.monotonic):
+        self._fn = fn
+        self._memoize, self._ttl, self._clock = memoize, ttl, clock
+        self._memo = { }        # ( var, field ) -> ( value, expiry or None )
+        self._set = { }         # var -> value, set through the Expander;
+        self._set_fields = { }  # var -> { field: value } for var.field sets over a loaded var;
+        self._lock = threading.Lock()
+        self.version = 0        # Moves on every set() and invalidate(), for Expander's output cache;
+        self.loads = self.hits = 0
+        return
+
+    @classmethod
+    def environ(cls, environ = None, **kwa):
+        "The process environment (or environ), read at lookup time rather than copied;"
+        environ = os.environ if environ is None else environ
+        kwa.setdefault('memoize', False)
+        return cls(environ.__getitem__, **kwa)
+
+    def load(self, var, field = None):
+        "Uncached value of var (or var.field); raises KeyError when there's no such var;"
+        if self._fn is None:
+            raise KeyError(var)
+        value = self._fn(var)
+        return value if field is None else value[field]
+
+    def lookup(self, var, field = None):
+        "Value of var (or var.field): set values first, then the memo, then load();"
+        if var in self._set_fields and field in self._set_fields[var]:
+            return self._set_fields[var][field]
+        if var in self._set:
+            value = self._set[var]
+            return value if field is None else value[field]
+        if not self._memoize:
+            self.loads += 1
+            return self.load(var, field)
+        key = ( var, field )
+        entry = self._memo.get(key)
+        if entry is not None and (entry[1] is None or self._clock() <= entry[1]):
+            self.hits += 1
+            return entry[0]
+        value = self.load(var, field)
+        with self._lock:
+            self.loads += 1
+            self._memo[key] = ( value, None if self._ttl is None else self._clock() + self._ttl )
+        return value
+
+    def set(self, var, field, v):
+        "Set var (field None) or var.field to v, without loading anything else;"
+        with self._lock:
+            if field is None:
+                self._set[var] = v
+                self._set_fields.pop(var, None)
+            elif isinstance(self._set.get(var), dict):
+                self._set[var] = { **self._set[var], field: v }
+            else:
+                self._set_fields[var] = { **self._set_fields.get(var, { }), field: v }
+            self.version += 1
+
+    def invalidate(self, var = None):
+        "Forget memoized values, of var or of everything;"
+        with self._lock:
+            if var is None:
+                self._memo.clear()
+            else:
+                for key in [ key for key in self._memo if key[0] == var ]:
+                    del self._memo[key]
+            self.version += 1
+
+    def get(self, var, dflt = None):
+        try:
+            return self.lookup(var)
+        except KeyError:
+            return dflt
+
+    def __getitem__(self, var):
+        return self.lookup(var)
+
+    def __setitem__(self, var, v):
+        self.set(var, None, v)
+
+    def __contains__(self, var):
+        try:
+            self.lookup(var)
+        except KeyError:
+            return False
+        return True
+
+    @property
+    def cacheable(self):
+        "Whether a value can only change through set() or invalidate() (so outputs using it can be cached);"
+        return self._memoize and self._ttl is None
+
+    def stats(self):
+        return dict(loads=self.loads, hits=self.hits, memoized=len(self._memo), set=len(self._set))
+
 
 class Expander():
     "Variable expansion, tokenizers, etc.;"
+    _helper_sets = { }  # ( start, end ) -> dict of shared VarHelpers
     # VARPAT     = r'\s*?(\~{0,1}[\w\.\:]+)\s*?'
 
     def __init__(self, *dicts, **kwa):
         self._debug = kwa.get('debug', False)
         self._start = start = kwa.get('start', '{')
         self._end   = end = kwa.get('end', '}')
+        self._tokenizer = kwa.get('tokenizer', None) # 'shlex' (default), 'regex' or a callable;
         self._namespaces = kwa.get('namespaces', None)
         if self._namespaces:
             if 'default' not in self._namespaces:
                 self._namespaces['default'] = { }
-        self._helpers = dict(FIELDED = VarHelper('FIELDED', r'\~{0,1}(\w+)\.(\w+)', start=start, end=end),
-                             DEEP = VarHelper('DEEP', r'\~{0,1}(\w+):(\w+)\.(\w+)', start=start, end=end),
-                             SIMPLE = VarHelper('SIMPLE', r'\~{0,1}(\w+)', start=start, end=end),
-                             NAMESPACED = VarHelper('NAMESPACED', r'\~{0,1}(\w+)\:(\w+)', start=start, end=end))
+        self._helpers = Expander.make_helpers(start, end)
+        # flatten=True keeps a merged innermost-wins view of the scopes, so a lookup is one dict probe;
+        self._flatten = kwa.get('flatten', False)
+        # threadsafe=True makes writes copy-on-write under a lock, see README (Threads);
+        self._threadsafe = kwa.get('threadsafe', False)
+        # recursive=False leaves references inside variable values as they are;
+        self._recursive = kwa.get('recursive', True)
+        # limits=ExpansionLimits(...) bounds every expand(), see README (Limits);
+        self._limits = kwa.get('limits', None)
+        self._lock = threading.RLock() if self._threadsafe else None
+        self._stamps = Stamps()
+        # output_cache=N remembers up to N rendered expand() outputs, see README (Output cache);
+        maxsize = kwa.get('output_cache', None)
+        self._output_cache = OutputCache(maxsize) if maxsize else None
+        # stats=True (or a shared Stats) counts and times expansions, hook=fn sees each update, see README (Stats);
+        self._stats = Stats.of(kwa.get('stats', None), kwa.get('hook', None))
         if not self._namespaces:
-            self.reset(*dicts)
+            self.reset(*(dicts or ( dict(), dict() )))
         return
 
     def __getitem__(self, k):
         "Normal-scoping (innermost to outermost) reference by key"
         if self._namespaces:
             return self._getitem_ns(k)
-        for dict_ in self._locals_first:
+        if self._flatten:
+            flat = self._flat_view()
+            if k in flat:
+                return flat[k]
+            raise KeyError(f"No such key {k} in any known scope")
+        for dict_ in reversed(self._scopes):
             if k in dict_:
                 return dict_[k]
         raise KeyError(f"No such key {k} in any known scope")
@@ -310,8 +1412,10 @@ class Expander():
     def __contains__(self, k):
         "Using same logic as getitem, search for the presence of the requested key;"
         if self._namespaces:
-            return self._contains_namespaced(self, k)
-        for dict_ in self._locals_first:
+            return self._contains_ns(k)
+        if self._flatten:
+            return k in self._flat_view()
+        for dict_ in reversed(self._scopes):
             if k in dict_:
                 return True
         return False
@@ -321,7 +1425,88 @@ class Expander():
         if self._namespaces:
             self._setitem_ns(k, v)
             return
-        self.locals[k] = v
+        if self._threadsafe:
+            with self._lock:
+                inner = dict(self._scopes[-1])
+                inner[k] = v
+                self._publish(self._scopes[:-1] + [ inner ])
+            return
+        self._scopes[-1][k] = v
+        if self._bump(-1):
+            self._flat_state[2][k] = v # Innermost always wins, so the flat view stays valid;
+
+    def _bump(self, i = None):
+        "Stamp a change to scope i (None: the scope list); True if the flat view was current and can be patched;"
+        stamps = self._stamps
+        scopes, version, flat = self._flat_state
+        current = scopes is self._scopes and version == stamps.version
+        if i is None:
+            stamps.version = next(_STAMPS)
+        else:
+            stamps.bump(id(self._scopes[i]))
+        if current:
+            self._flat_state = ( scopes, stamps.version, flat )
+        return current
+
+    def _publish(self, scopes):
+        "threadsafe mode: swap in a new scope list (readers keep whichever list they already hold);"
+        if scopes:
+            self._stamps.bump(id(scopes[-1]))
+        self._stamps.version = next(_STAMPS)
+        self._scopes = scopes
+
+    def _flat_view(self):
+        "The merged scopes, rebuilt when the scope list or the version counters say it is stale;"
+        scopes, version = self._scopes, self._stamps.version
+        state = self._flat_state
+        if state[0] is not scopes or state[1] != version:
+            flat = { }
+            for dict_ in scopes:
+                flat.update(dict_)
+            state = self._flat_state = ( scopes, version, flat )
+        return state[2]
+
+    def push_scope(self, dict_ = None):
+        "Enter a new innermost scope (O(1), plus merging its keys into a current flat view);"
+        dict_ = dict() if dict_ is None else dict_
+        if self._threadsafe:
+            with self._lock:
+                self._publish(self._scopes + [ dict_ ])
+            return dict_
+        self._scopes.append(dict_)
+        if self._bump(-1):
+            self._flat_state[2].update(dict_)
+        return dict_
+
+    def pop_scope(self):
+        "Leave the innermost scope, returning it;"
+        if len(self._scopes) < 2:
+            raise IndexError("Expander.pop_scope: Can't pop the outermost (globals) scope")
+        if self._threadsafe:
+            with self._lock:
+                dict_ = self._scopes[-1]
+                self._publish(self._scopes[:-1])
+            return dict_
+        dict_ = self._scopes.pop()
+        self._stamps.of.pop(id(dict_), None) # ids get reused, a dict pushed later is stamped afresh;
+        if self._bump():
+            flat = self._flat_state[2]
+            for k in dict_:
+                for outer in reversed(self._scopes):
+                    if k in outer:
+                        flat[k] = outer[k]
+                        break
+                else:
+                    del flat[k]
+        return dict_
+
+    def touch(self, which = None):
+        "Tell the Expander a scope (index, default innermost) or namespace (name, default all) changed behind its back;"
+        if self._namespaces:
+            for ns in ([ which ] if which is not None else list(self._namespaces)):
+                self._stamps.bump(ns)
+            return
+        self._stamps.bump(id(self._scopes[-1 if which is None else which]))
 
     # All the other expanding code goes here:
     def __call__(self, expr, **kwa) -> str:
@@ -330,166 +1515,258 @@ class Expander():
 
     def _setitem_ns(self, k, v):
         where = "Expander._setitem_ns"
-        if ('.' not in k) and (':' not in k):
-            self._namespaces['default'][k] = v
-        syntax_type, ns, var, field = self._validate_ns(k, getting=False)
-        if syntax_type == 'simple':
-            self._namespaces[ns][var] = v
-        elif syntax_type in ['deep', 'fielded' ]: # ******** BREAKOUT DEEP vs FIELDED ********
-            if ns not in self._namespaces:
-                self._namespaces[ns] = dict()
-            if var not in self._namespaces[ns]:
-                self._namespaces[ns][var] = dict()
-            self._namespaces[ns][var][field] = v
-        elif syntax_type == 'namespaced':
-            self._namespaces[ns][var] = v
-        else:
-            raise IndexError(f"{where}: {k} didn't match any known pattern {syntax_type}")
+        ref = _parse_key(k)
+        if ref.getlen:
+            raise IndexError(f"{where}: Can't set a length reference {k}")
+        provider = self._namespaces.get(ref.ns)
+        if isinstance(provider, Provider):
+            provider.set(ref.var, ref.field, v) # Providers lock for themselves;
+            self._stamps.bump(ref.ns)
+            return
+        if self._threadsafe:
+            with self._lock:
+                # Copy-on-write: readers holding the old namespaces never see a half-made change;
+                namespaces = dict(self._namespaces)
+                dict_ = namespaces[ref.ns] = dict(namespaces.get(ref.ns, { }))
+                if ref.field is None:
+                    dict_[ref.var] = v
+                else:
+                    fields = dict_[ref.var] = dict(dict_.get(ref.var, { }))
+                    fields[ref.field] = v
+                self._namespaces = namespaces
+                self._stamps.bump(ref.ns)
+            return
+        self._stamps.bump(ref.ns)
+        if ref.field is None:
+            self._namespaces.setdefault(ref.ns, dict())[ref.var] = v
+            return
+        dict_ = self._namespaces.setdefault(ref.ns, dict())
+        if ref.var not in dict_:
+            dict_[ref.var] = dict()
+        dict_[ref.var][ref.field] = v
 
     def _getitem_ns(self, k):
-        where = "Expander._getitem_ns"
-        if ('.' not in k) and (':' not in k):
-            return self._namespaces['default'][k]
-        val_tup = self._validate_ns(k)
-        if val_tup[0] == False:
-            raise IndexError(f"{where}: {k} invalid")
-        value = val_tup[-1]
-        return value
+        ref = _parse_key(k)
+        if ref.kind == 'simple' and not ref.getlen:
+            return self._namespaces['default'][ref.var] # Plain default-namespace names give the raw value;
+        value = self._lookup_ns(ref)
+        return str(len(value)) if ref.getlen else str(value)
+
+    def _contains_ns(self, k):
+        try:
+            self._lookup_ns(_parse_key(k))
+        except IndexError:
+            return False
+        return True
 
     def get(self, k, dflt = None) -> Any:
         "Same as __getitem__, but accepts a default value;"
         if self._namespaces:
             return self._get_ns(k, dflt)
-        for dict_ in self._locals_first:
+        if self._flatten:
+            return self._flat_view().get(k, dflt)
+        for dict_ in reversed(self._scopes):
             if k in dict_:
                 return dict_[k]
         return dflt
 
     def _get_ns(self, k, dflt = ""):
         "get with default, parses namespace syntax: name:var.field"
-        where = "Expander.get_ns"
-        val_tup = self._validate_ns(k)
-        if val_tup[0] == False:
+        try:
+            ref = _parse_key(k)
+            value = self._lookup_ns(ref)
+        except IndexError:
             return dflt
-        return val_tup[-1]
+        return str(len(value)) if ref.getlen else str(value)
 
     def _validate_ns(self, k, contains = False, getting=True):
-        "Make sure the namespaced var syntax is valid;"
-        def _contained(contains, exception, if_contained_value):
-            "Raise an exception if contains == False, or return if_contained_value if k cannot be dereferenced;"
-            if not contains:
-                raise exception
-            # do __contains__, indicated value for this state
-            return if_contained_value
-
-        where = "Expander._validate_ns"
-        default_ns = self._namespaces['default']
-        vhs = self._helpers             # Dict of VarHelpers
-        deep, namespaced, fielded, simple = vhs['DEEP'], vhs['NAMESPACED'], vhs['FIELDED'], vhs['SIMPLE']
-        falsy = ( False, False, False, False )
-        setting = (not getting) and (not contains)
-        getlen = k.startswith("~")
-        # Initial deep match for namespace:varname.field
-        if deep.match(k):
-            core, ns, var, field = deep.groups
-            if getting:
-                if ns not in self._namespaces:
-                    return _contained(contains, IndexError(f"{where}: Bad namespace {ns} in {k}"), False)
-                dict_  = self._namespaces[ns]
-                if var not in dict_:
-                    return _contained(contains, IndexError(f"{where}: No such var {var} in {k}"), False)
-                field_dict = dict_[var]
-                if type(field_dict) != type(dict()):
-                    return _contained(contains, IndexError(f"{where}: {k} does not have fields (dict)"), False)
-                if field not in field_dict:
-                    return _contained(contains, IndexError(f"{where}: {k} doesn't have a field {field}"), False)
-                value = str(len(field_dict[field])) if getlen else str(field_dict[field])
-                return 'deep', ns, var, field, value # Short circuit
-            if setting:
-                return 'deep', ns, var, field
-            # getting == False, contains == True
-            if ns not in self._namespaces:
-                return falsy
-            if var not in self._namespaces[ns]:
-                return falsy
-            if field not in self._namespaces[ns][var]:
-                return falsy
-            return deep, ns, var, field # final __contains__ state;
-
-        if namespaced.match(k): # Match namespace:varname
-            core, ns, var = namespaced.groups
-            if getting:
-                if ns not in self._namespaces:
-                    return _contained(contains, IndexError(f"{where}: {k} references a non-existing namespace {ns}"), False)
-                dict_ = self._namespaces[ns]
-                if var not in dict_:
-                    return _contained(contains, IndexError(f"{where}: {k} references a non-existing var {var}"), False)
-            if setting:
-                return 'namespaced', ns, var, None
-            # Not getting, Not setting, just contains;
-            if ns not in self._namespaces:
-                return falsy
-            dict_ = self._namespaces[ns]
-            if var not in dict_:
-                return falsy
-            value = str(len(dict_[var])) if getlen else str(dict_[var])
-            return 'namespaced', ns, var, value
-
-        if fielded.match(k): # Match x.y in default namespace;
-            ns = 'default'
-            k, var, field = fielded.groups
-            if getting:
-                if var not in default_ns:
-                    return _contained(contains, IndexError(f"{where}: {k} not in default namespace"))
-                if type(default[var]) != type({}):
-                    raise IndexError(f"{where}: {k} is not indexable to field")
-                return 'fielded', ns, var, str(default_ns[var][field])
-            if setting:
-                return 'fielded', ns, var, field
-            if var not in default_ns:
-                return falsy
-            if field not in default_ns[var]:
-                return falsy
-            value = str(len(default_ns[var][field])) if getlen else str(default_ns[var][field])
-            return 'fielded', ns, var, value
-
-        if simple.match(k):
-            var = simple.groups[0]
-            if getting:
-                if var not in default_ns:
-                    raise IndexError(f"{where}: {k} not in default namespace")
-                value = str(len(default_ns[var])) if getlen else str(default_ns[var])
-                return 'simple', 'default', k, value
-            if setting:
-                return 'simple', 'default', k, None
-            if var not in default_ns:
-                return _contained(contains, IndexError(f"{where}: {k} couldn't be parsed"), False)
-
-        raise IndexError(f"{where}: Couldn't parse {k} as a variable name")
+        "Classify k (through the parsed-key cache) and, unless setting, dereference it;"
+        ref = _parse_key(k)
+        if not (getting or contains):
+            return ref.kind, ref.ns, ref.var, ref.field
+        try:
+            value = self._lookup_ns(ref)
+        except IndexError:
+            if contains:
+                return ( False, False, False, False )
+            raise
+        return ref.kind, ref.ns, ref.var, ref.field, str(len(value)) if ref.getlen else str(value)
+
+    @staticmethod
+    def parse_key(k) -> VarRef:
+        "Parsed form of a [~]name, [~]ns:var, [~]var.field or [~]ns:var.field key, memoized;"
+        return _parse_key(k)
+
+    @staticmethod
+    def key_cache_info():
+        return _parse_key.cache_info()
+
+    def compile(self, text) -> Template:
+        "Fetch (or build and cache) the compiled Template for text under this Expander's delimiters;"
+        return _compile_template(text, self._start, self._end, self._tokenizer)
+
+    def expand_typed(self, text):
+        """expand() that keeps values native: text that is a single reference gives that value itself (an int
+        stays an int), otherwise values are converted to str once, as they're joined into the output.
+
+        References may carry a format spec, {frame:04d} or {ns:var.field:.2f}; str values are converted to
+        the number type the spec asks for.  {name:spec} is read as ns:var when name is a namespace (or
+        ns:var a scoped name), and when spec isn't a valid format spec;
+        """
+        budget = Budget(self._limits, "Expander.expand_typed") if self._limits else None
+        return _compile_template(text, self._start, self._end, self._tokenizer, True).render_typed(self, budget)
+
+    def value(self, k, dflt = _UNSET):
+        "Native value for any key syntax (nested references expanded, ~ keys give an int, specs are applied);"
+        ref = _parse_key(k) if ':' not in k or _CORE_REX.fullmatch(k) else None
+        budget = Budget(self._limits, "Expander.value") if self._limits else None
+        try:
+            if ref is None:
+                # key:spec, with a key that isn't ns:var shaped (eg: a.b:.2f);
+                k, spec = k.rsplit(':', 1)
+                ref = _parse_key(k)._replace(spec=spec)
+            value, spec = self._typed_ref(ref, self._view(), { }, budget)
+        except (IndexError, KeyError):
+            if dflt is _UNSET:
+                raise
+            return dflt
+        if value is _UNSET:
+            if dflt is _UNSET:
+                raise KeyError(f"No such key {k} in any known scope")
+            return dflt
+        return value if spec is None else _format_value(value, spec)
+
+    def _typed_ref(self, ref, view, memo, budget = None):
+        "( native value, or _UNSET for an unknown scoped name; format spec or None ) for a parsed VarRef;"
+        try:
+            value = self._raw_value(ref, view)
+        except (IndexError, KeyError):
+            if not self._is_spec(ref, view):
+                raise
+            value = _UNSET
+        if value is _UNSET:
+            if self._is_spec(ref, view):
+                # {frame:04d}: the name frame with the spec 04d;
+                name = _parse_key(("~" if ref.getlen else "") + ref.ns)
+                return self._typed_ref(name._replace(full=ref.full, spec=ref.var), view, memo, budget)
+            return _UNSET, None
+        if ref.getlen:
+            return len(value), ref.spec
+        if self._recursive and isinstance(value, str) and self._start in value and self.expandable(value):
+            value = self._expand_value(ref.name, value, view, memo, budget)
+        return value, ref.spec
+
+    def _is_spec(self, ref, view):
+        "Whether ns:var in ref is better read as name:spec (ns isn't a namespace, var is a valid format spec);"
+        if ref.kind != 'namespaced' or ref.spec is not None:
+            return False
+        if self._namespaces and ref.ns in view:
+            return False
+        return _SPEC_REX.fullmatch(ref.var) is not None
 
     def expand(self, text, **kwa):
-        tokens = Expander.tokenize_static(text)
-        olist = []
-        for token in tokens:
-            if not self.expandable(token):
-                olist.append(token)
-                continue
-            # print(f"Expandable '{token}'")
-            new_str = token
-            while self.expandable(new_str):
-                # print(f"expanding {new_str}")
-                new_str = self.expand_token(token) # was: xp.expand_tokens(token)[0]
-            olist.append(new_str)
-        # print(f"olist: {olist}")
-        ostr = " ".join(olist)
-        # tokens = self.simple_tokenize(text, **kwa)
-        # expanded_tokens = self.expand_tokens(*tokens)
-        return ostr
+        "Tokenize text and expand every reference; repeat texts reuse their cached Template;"
+        budget = Budget(self._limits, "Expander.expand") if self._limits else None
+        if self._stats is not None:
+            return self._expand_counted(text, budget)
+        if self._output_cache is not None:
+            return self._render_cached(self.compile(text), budget)
+        return self.compile(text).render(self, budget=budget)
+
+    def _expand_counted(self, text, budget = None):
+        "expand() with stats: compile and render are timed, the references resolved are counted by syntax;"
+        stats, cache = self._stats, self._output_cache
+        misses = _compile_template.cache_info().misses
+        with stats.phase('compile'):
+            template = self.compile(text)
+        if _compile_template.cache_info().misses != misses:
+            stats.count('tokens', template.ntokens)
+        with stats.phase('render'):
+            if cache is not None:
+                hits = cache.hits
+                output = self._render_cached(template, budget)
+                if cache.hits != hits:
+                    stats.count('output_cache.hits')
+                    return output
+            else:
+                output = template.render(self, budget=budget)
+        self._count_refs(template.refs) # References inside values are counted as _expand_value looks them up;
+        return output
+
+    def _count_refs(self, refs):
+        "Add refs to the per-syntax resolved counts, one update per syntax;"
+        kinds = { }
+        for ref in refs:
+            kinds[ref.kind] = kinds.get(ref.kind, 0) + 1
+        for kind, n in kinds.items():
+            self._stats.count(f"refs.{kind}", n)
+
+    def _reads(self, refs, scopes):
+        "What a render that looked up refs read: their namespaces, or the outermost scope any resolved in (scoped);"
+        if self._namespaces:
+            return tuple(sorted({ ref.ns for ref in refs }))
+        # Anything inside the outermost scope a value came from could shadow it, so all of those count;
+        lowest = len(scopes)
+        for ref in refs:
+            for i in range(len(scopes) - 1, -1, -1):
+                if ref.name in scopes[i]:
+                    break
+            else:
+                i = 0 # Unresolved: a write to any scope can change the output;
+            lowest = min(lowest, i)
+        return lowest
+
+    def _deps(self, reads, scopes):
+        "The stamps of what _reads() found;"
+        of = self._stamps.of
+        if self._namespaces:
+            namespaces = self._namespaces
+            return tuple(( of.get(ns, 0), getattr(namespaces.get(ns), 'version', 0) ) for ns in reads)
+        return len(scopes), tuple(( id(dict_), of.get(id(dict_), 0) ) for dict_ in scopes[reads:])
+
+    def _render_cached(self, template, budget = None):
+        "render() through the output cache; a render that overlaps a write isn't cached;"
+        cache, text = self._output_cache, template.text
+        if not template.refs:
+            return template.render(self)
+        with self._lock or _NOLOCK:
+            version = self._stamps.version
+            scopes = None if self._namespaces else self._scopes
+            output = cache.get(text, lambda reads: self._deps(reads, scopes))
+            if output is not None:
+                return output
+        memo = { }
+        output = template.render(self, memo=memo, budget=budget)
+        # Names memo met inside variable values were read too;
+        refs = template.refs + [ _parse_key(name) for name in memo ]
+        with self._lock or _NOLOCK:
+            if self._stamps.version == version:
+                reads = self._reads(refs, scopes)
+                if self._namespaces and not all(getattr(self._namespaces.get(ns), 'cacheable', True) for ns in reads):
+                    return output   # Reads a provider whose values can change on their own;
+                cache.put(text, self._deps(reads, scopes), reads, output)
+        return output
+
+    def output_cache_info(self):
+        "hits, misses, invalidations (misses on a stale entry), entries and maxsize of the output cache, or None;"
+        return self._output_cache.info() if self._output_cache is not None else None
+
+    def output_cache_clear(self):
+        if self._output_cache is not None:
+            self._output_cache.clear()
+
+    def stats(self):
+        "Snapshot of the counters and phase times (see Stats), or None if stats weren't asked for;"
+        return self._stats.snapshot() if self._stats is not None else None
 
     def expandable(self, token):
-        if self._start in token:
-            if self._end in token:
-                if token.index(self._start) < token.index(self._end):
+        return Expander.expandable_static(token, self._start, self._end)
+
+    @staticmethod
+    def expandable_static(token, start, end):
+        if start in token:
+            if end in token:
+                if token.index(start) < token.index(end):
                     return True
         return False
 
@@ -502,42 +1779,57 @@ class Expander():
         self._error = f"Can't process value of type {type(v)}"
         return False
 
-    def _find_right_regex(self, token) -> VarHelper:
+    def _find_right_regex(self, token) -> Dict:
         result = dict(found=0, all=[ ], which={ })
         matchers = [ 'SIMPLE', 'NAMESPACED', 'FIELDED', 'DEEP' ] # Do not reorder;
         for xpndr_nm in matchers:
             vh = self._helpers[xpndr_nm] # This should be a VarHelper
-            # print(f"Expander._find_right_regex: {str(vh)} : {token}")
-            if not vh.match(token):
+            matches = vh.findall(token)
+            if not matches:
                 continue
-            if not vh.matches:
-                continue
-            # matcher = xpndr.helpers[xpndr_nm]
-            result['found'] += len(vh['matches'])
-            # found = xpndr.findall(token) # Now implement findall and replace? Or defer this to caller?
-            result['all'] += vh['all']
-            result['which'][xpndr.name] = vh['all']
-            # print("Expander._find_right_regex: matched")
+            result['found'] += len(matches)
+            result['all'] += matches
+            result['which'][vh.name] = matches
         # Now caller (expand_token) should do the suball against result;
         return result
 
     def expand_token(self, token, **kwa):
-        subtokens = self._find_subtokens(token)
-        if not subtokens:
-            return token
-        start, end = len(self._start), -len(self._end)
-        new_token = token
-        for full, core, *others in subtokens:
-            if core.startswith("~"):
-                v = str(len(self[core[1:]]))
-            else:
-                v = self.get(core, full) # Is this a good default (unexpanded) value?
-            new_token = new_token.replace(full, v)
-        return new_token
+        view, memo = self._view(), { }
+        if self._stats is not None:
+            return self._expand_token_counted(token, view, memo)
+        if not self._limits:
+            return self.scanner.substitute(token, lambda ref: self._resolve_ref(ref, view, memo))
+        budget = Budget(self._limits, "Expander.expand_token")
+        def resolve(ref):
+            value = self._resolve_ref(ref, view, memo, budget)
+            budget.charge(ref.name, len(value))
+            return value
+        token = self.scanner.substitute(token, resolve)
+        budget.charge(token, len(token), count=0)
+        return token
+
+    def _expand_token_counted(self, token, view, memo):
+        "expand_token() with stats: timed, with its references counted by syntax;"
+        budget = Budget(self._limits, "Expander.expand_token") if self._limits else None
+        refs = [ ]
+        def resolve(ref):
+            refs.append(ref)
+            value = self._resolve_ref(ref, view, memo, budget)
+            if budget is not None:
+                budget.charge(ref.name, len(value))
+            return value
+        with self._stats.phase('expand_token'):
+            token = self.scanner.substitute(token, resolve)
+            if budget is not None:
+                budget.charge(token, len(token), count=0)
+        self._count_refs(refs)
+        return token
 
     def expand_tokens(self, *tokens, **kwa):
         expanded_tokens = [ ]
         default = kwa.get('default', "")
+        if self._stats is not None:
+            self._stats.count('tokens', len(tokens))
         for token in tokens:
             # print(f"expand_tokens: {token}")
             if not self.expandable(token):
@@ -556,41 +1848,153 @@ class Expander():
         return expanded_tokens
 
     def _find_subtokens(self, token: AnyStr) -> List:
-        found = set()
-        for helper in [ 'SIMPLE', 'NAMESPACED', 'FIELDED', 'DEEP' ]:
-            vh = self._helpers[helper]
-            helper_matches = vh.findall(token)
-            if helper_matches:
-                found = found.union(set(helper_matches))
-        return list(found)
+        "Unique ( full, core ) pairs for every reference in token;"
+        found = { ref.full: ( ref.full, ("~" if ref.getlen else "") + ref.name )
+                  for literal, ref in self.scanner.scan(token) if ref }
+        return list(found.values())
 
     def format(self, k):
-        "Use f-string formmating against expanded string, not this..., please..."
+        "Format a data:spec value (eg: 3.14159:.2f) through the parsed-spec cache; see expand_typed for {k:spec};"
         v = self[k]
         if ':' not in v:
             return v
         v_data, v_fmt = re.split(r'\s*:\s*', v, 1)
         v_data, v_fmt = v_data.strip(), v_fmt.strip()
-        type_ = str
-        if v_data.isdigit():
-            type_ = int
-        elif re.match(r'\d+\.\d*', v_data):
-            type_ = float
-        v_data = type_(v_data)
-        return format(v_data, v_fmt)
+        if _parse_spec(v_fmt)[0] is None:
+            # The spec has no type, so numeric-looking data is still formatted as a number;
+            if v_data.isdigit():
+                v_data = int(v_data)
+            elif re.match(r'\d+\.\d*', v_data):
+                v_data = float(v_data)
+        return _format_value(v_data, v_fmt)
+
+    def _lookup_ns(self, ref, namespaces = None):
+        "Raw value for a parsed VarRef in namespaced mode;"
+        where = "Expander._lookup_ns"
+        try:
+            namespace = (namespaces or self._namespaces)[ref.ns]
+            if isinstance(namespace, Provider):
+                return namespace.lookup(ref.var, ref.field)
+            value = namespace[ref.var]
+            if ref.field is not None:
+                value = value[ref.field]
+        except (KeyError, TypeError):
+            if self._stats is not None:
+                self._stats.count(f"misses.{ref.ns}")
+            raise IndexError(f"{where}: {ref.name} doesn't resolve in namespace {ref.ns}") from None
+        return value
+
+    def _view(self):
+        "One consistent snapshot to resolve a whole render against: the namespaces, or the scopes (innermost last);"
+        if self._namespaces:
+            return self._namespaces
+        if self._flatten:
+            return [ self._flat_view() ]
+        return self._scopes
+
+    def _raw_value(self, ref, view):
+        "Value of a parsed VarRef in view; an unknown scoped ref gives _UNSET (namespaced ones raise IndexError);"
+        if self._namespaces:
+            return self._lookup_ns(ref, view)
+        for dict_ in reversed(view):
+            if ref.name in dict_:
+                return dict_[ref.name]
+        if self._stats is not None:
+            self._stats.count('misses.scopes')
+        if ref.getlen:
+            raise KeyError(f"No such key {ref.name} in any known scope")
+        return _UNSET
+
+    def _resolve_ref(self, ref, view = None, memo = None, budget = None):
+        "Expanded (string) value of a parsed VarRef; ~ refs give the length of the (raw) value;"
+        view = view or self._view()
+        value = self._raw_value(ref, view)
+        if value is _UNSET:
+            return ref.full # Unknown vars are left unexpanded;
+        if ref.getlen:
+            return str(len(value))
+        value = str(value)
+        if not self._recursive or self._start not in value or not self.expandable(value):
+            return value
+        return self._expand_value(ref.name, value, view, { } if memo is None else memo, budget)
+
+    def _expand_value(self, name, text, view, memo, budget = None):
+        """Fully expand the value text of variable name, each variable it reaches being expanded once;
+
+        memo maps the names (~name for lengths) met during one render to their expanded values, or to None
+        while a name's own expansion is under way, which is how a cycle shows up.  The walk keeps its own
+        stack, so the depth of a chain isn't bounded by the recursion limit.  A Budget is charged for every
+        substitution, against the length of the value it went into and the nesting depth (the render is 0);
+        """
+        if name in memo:
+            if memo[name] is None:
+                self._cycle(name, memo)
+            return memo[name]
+        memo[name] = None
+        if budget is not None:
+            budget.charge(name, len(text), 1, count=0)
+        # [ name, slots, parts, next slot, length so far ] per value being expanded;
+        stack = [ self._value_frame(name, text) ]
+        while True:
+            frame = stack[-1]
+            name, slots, parts, n, length = frame
+            if n == len(slots):
+                value = memo[name] = "".join(parts)
+                stack.pop()
+                if not stack:
+                    return value
+                frame = stack[-1]
+                name, slots, parts, n, length = frame
+                i, ref = slots[n]
+            else:
+                i, ref = slots[n]
+                key = "~" + ref.name if ref.getlen else ref.name
+                value = memo.get(key, _UNSET)
+                if value is None:
+                    self._cycle(key, memo)
+            if value is _UNSET:
+                if self._stats is not None:
+                    self._stats.count(f"refs.{ref.kind}")
+                value = self._raw_value(ref, view)
+                if value is _UNSET:
+                    value = ref.full
+                elif ref.getlen:
+                    value = str(len(value))
+                else:
+                    value = str(value)
+                    if self.expandable(value):
+                        memo[key] = None
+                        if budget is not None:
+                            budget.charge(key, len(value), len(stack) + 1, count=0)
+                        stack.append(self._value_frame(key, value))
+                        continue
+                memo[key] = value
+            parts[i] = value
+            frame[3] += 1
+            if budget is not None:
+                frame[4] = length - len(ref.full) + len(value)
+                budget.charge(name, frame[4], len(stack))
+
+    def _value_frame(self, name, text):
+        template = _compile_value(text, self._start, self._end)
+        return [ name, template.slots, list(template._parts), 0, len(text) ]
+
+    def _cycle(self, name, memo) -> NoReturn:
+        chain = [ k for k, v in memo.items() if v is None ]
+        chain = chain[chain.index(name):] + [ name ]
+        raise ExpansionCycleError(f"Expander.expand: {' -> '.join(chain)} refers back to {name}")
 
     def innermost(self, k):
         "Explicit search for key from innermost to outermost;"
-        ## dict_ = self._locals_first[0]
         try:
-            v = self.mostest(k, self._locals_first)
+            v = self.mostest(k, reversed(self._scopes))
         except KeyError as e:
             raise KeyError(f"No such key {k} from innermost scopes outward")
         return v
 
     def local_scope(self, k):
         "Explicitly only use local vars;"
-        return self._locals_first[0][k]
+        return self._scopes[-1][k]
 
     def mostest(self, k, which):
         "Search based on a provided list of dicts, in order;"
@@ -602,36 +2006,218 @@ class Expander():
     def outermost(self, k):
         "Search for key in outermost dict only;"
         try:
-            v = self.mostest(k, self._globals_first)
+            v = self.mostest(k, self._scopes)
         except KeyError as e:
             raise KeyError(f"No such key {k} in from outermost scopes inward")
         return v
 
+    @staticmethod
+    def make_helpers(start="{", end="}"):
+        "The VarHelpers for the four reference syntaxes, compiled once per ( start, end ) and shared;"
+        key = ( start, end )
+        helpers = Expander._helper_sets.get(key)
+        if helpers is None:
+            helpers = dict(FIELDED = VarHelper('FIELDED', r'\~{0,1}(\w+)\.(\w+)', start=start, end=end),
+                           DEEP = VarHelper('DEEP', r'\~{0,1}(\w+):(\w+)\.(\w+)', start=start, end=end),
+                           SIMPLE = VarHelper('SIMPLE', r'\~{0,1}(\w+)', start=start, end=end),
+                           NAMESPACED = VarHelper('NAMESPACED', r'\~{0,1}(\w+)\:(\w+)', start=start, end=end))
+            helpers = Expander._helper_sets.setdefault(key, helpers)
+        return helpers
+
+    def fork(self, *dicts, **namespaces):
+        """Cheap child Expander sharing this one's helpers, settings and dicts (nothing is copied);
+
+        Scoped: dicts (default: one new empty dict) become the child's innermost scopes, the parent's scopes
+        sit outside them.  Namespaced: the given namespaces are added (or shadowed) in the child only, writes
+        into the shared namespaces are seen by the parent too;
+        """
+        child = Expander.__new__(Expander)
+        child.__dict__.update(self.__dict__)
+        if self._threadsafe:
+            child._lock = threading.RLock()
+        if self._output_cache is not None:
+            child._output_cache = OutputCache(self._output_cache._maxsize) # Stamps stay shared;
+        if self._namespaces:
+            child._namespaces = { **self._namespaces, **namespaces }
+        else:
+            child.reset(*self._scopes, *(dicts or ( dict(), )))
+        return child
+
+    def update(self, ns, mapping):
+        """Bulk xp[f"{ns}:{k}"] = v for every k, v in mapping, with one copy (threadsafe) and one stamp for all;
+
+        A "var.field" key sets one field of var and a dict value sets several, either way merging into the
+        fields var already has.  Keys are split on the dot, not parsed.  Scoped: ns is a scope index (-1 for
+        the innermost) and mapping is applied as is;
+        """
+        if not self._namespaces:
+            with self._lock or _NOLOCK:
+                if self._threadsafe:
+                    scopes = list(self._scopes)
+                    scopes[ns] = { **scopes[ns], **mapping }
+                    self._publish(scopes)
+                    return
+                self._scopes[ns].update(mapping)
+                if self._bump(ns):
+                    if ns in ( -1, len(self._scopes) - 1 ):
+                        self._flat_state[2].update(mapping) # Innermost always wins;
+                    else:
+                        self._flat_state = ( None, -1, { } )
+            return
+        plain, fielded = { }, { }
+        for k, v in mapping.items():
+            var, dot, field = k.partition('.')
+            if dot:
+                fielded.setdefault(var, { })[field] = v
+            elif isinstance(v, dict):
+                fielded.setdefault(var, { }).update(v)
+            else:
+                plain[k] = v
+        namespace = self._namespaces.get(ns)
+        if isinstance(namespace, Provider):
+            for var, v in plain.items():
+                namespace.set(var, None, v)
+            for var, fields in fielded.items():
+                for field, v in fields.items():
+                    namespace.set(var, field, v)
+            self._stamps.bump(ns)
+            return
+        with self._lock or _NOLOCK:
+            namespaces = dict(self._namespaces) if self._threadsafe else self._namespaces
+            if self._threadsafe or ns not in namespaces:
+                namespaces[ns] = dict(namespaces.get(ns, { }))
+            dict_ = namespaces[ns]
+            dict_.update(plain)
+            for var, fields in fielded.items():
+                current = dict_.get(var)
+                if not isinstance(current, dict):
+                    dict_[var] = fields
+                elif self._threadsafe:
+                    dict_[var] = { **current, **fields }
+                else:
+                    current.update(fields)
+            self._namespaces = namespaces
+            self._stamps.bump(ns)
+
+    def load(self, ns, fn, format = None):
+        "update() ns from a file, read in one pass by LOADERS[format] (default: from fn's extension, else 'vars');"
+        if format is None:
+            format = Expander.LOADER_EXTENSIONS.get(os.path.splitext(fn)[1].lower(), 'vars')
+        mapping = Expander.LOADERS[format](fn)
+        self.update(ns, mapping)
+        return mapping
+
+    @staticmethod
+    def read_vars(fn):
+        ".vars style file: name, whitespace, value per line; blank and # lines are skipped;"
+        mapping = { }
+        with open(fn, 'r') as ifd:
+            for ln in ifd:
+                words = ln.split(None, 1)
+                if not words or words[0].startswith('#'):
+                    continue
+                mapping[words[0]] = words[1].strip() if len(words) > 1 else ""
+        return mapping
+
+    @staticmethod
+    def read_json(fn):
+        "A JSON object: top level keys are vars, object values hold their fields;"
+        with open(fn, 'r') as ifd:
+            mapping = json.load(ifd)
+        if not isinstance(mapping, dict):
+            raise ValueError(f"Expander.read_json: {fn} doesn't hold a JSON object")
+        return mapping
+
+    @staticmethod
+    def read_ini(fn):
+        """An INI file: each [section] is a var, its keys are fields, keys before any section are plain vars;
+
+        One pass with str methods, where configparser runs regexes per line: key = value or key: value,
+        # and ; comment lines, indented continuation lines, case kept, no %-interpolation or [DEFAULT];
+        """
+        where = "Expander.read_ini"
+        mapping = { }
+        fields, key = mapping, None
+        with open(fn, 'r') as ifd:
+            for n, ln in enumerate(ifd, 1):
+                stripped = ln.strip()
+                if not stripped or stripped[0] in "#;":
+                    continue
+                if ln[0] in " \t" and key is not None:
+                    fields[key] += "\n" + stripped
+                    continue
+                if stripped[0] == "[" and stripped[-1] == "]":
+                    fields, key = mapping.setdefault(stripped[1:-1].strip(), { }), None
+                    continue
+                eq, colon = stripped.find("="), stripped.find(":")
+                split = eq if colon < 0 or (0 <= eq < colon) else colon
+                if split <= 0:
+                    raise ValueError(f"{where}: {fn}:{n}: Expected key = value, got {stripped}")
+                key = stripped[:split].rstrip()
+                fields[key] = stripped[split + 1:].lstrip()
+        return mapping
+
+    LOADERS = dict(vars=read_vars.__func__, json=read_json.__func__, ini=read_ini.__func__)
+    LOADER_EXTENSIONS = { '.json': 'json', '.ini': 'ini', '.cfg': 'ini' }
+
     def reset(self, *dicts):
         "reset -- use for scope change (ie: new locals at end of list);"
-        self._globals_first = list(dicts)
-        self._locals_first = self._globals_first[:]
-        self._locals_first.reverse()
-        return self._globals_first
+        # Only dicts new to this Expander are stamped: a fork (which shares the Stamps) mustn't invalidate
+        # what its parent cached against the scopes they share.  Current scopes are alive, so their ids are theirs;
+        current = { id(dict_) for dict_ in getattr(self, '_scopes', ( )) }
+        self._scopes = list(dicts)          # Outermost (globals) first, innermost (locals) last;
+        for dict_ in self._scopes:
+            if id(dict_) not in current:
+                self._stamps.bump(id(dict_))
+        self._flat_state = ( None, -1, { } )   # ( scope list, version, merged dict ) of the flat view;
+        return self._scopes
 
     def simple_tokenize(self, txt, **kwa):
         "Use static tokenizer to break up a string;"
         tokens = Expander.tokenize(txt, **kwa)
         return tokens
 
+    # shlex.split (posix, no comments) as regexes: a token is a run of bare chars, '...', "..." and \x escapes;
+    SHLEX_TOKEN_REX = re.compile(r"""((?:[^ \t\r\n'"\\]+|'[^']*'|"(?:[^"\\]|\\.)*"|\\.)+)|([^ \t\r\n])""", re.S)
+    SHLEX_PART_REX = re.compile(r"""'([^']*)'|"((?:[^"\\]|\\.)*)"|\\(.)|([^'"\\]+)""", re.S)
+    SHLEX_DQ_ESCAPE_REX = re.compile(r'\\(["\\])')
+    SHLEX_DQ_DANGLING_REX = re.compile(r'(?:[^"\\]|\\.)*\\', re.S)
+
     @staticmethod
     def rex_shlex(txt):
-        "Static lexer to break basic expressions into tokens;"
-        PATTERN = r"""( |[\"\'].*[\"\'])"""
-        REX = re.compile(pattern)
-        rl = list(filter(None, [t.strip() for t in rex.split(txt)]))
-        return rl
+        "Compiled-regex lexer with shlex.split quoting rules (and errors), but without its per-character loop;"
+        tokens = [ ]
+        for mtch in Expander.SHLEX_TOKEN_REX.finditer(txt):
+            token, stray = mtch.groups()
+            if stray is not None:
+                if stray == "\\":
+                    raise ValueError("No escaped character")
+                if stray == '"' and Expander.SHLEX_DQ_DANGLING_REX.fullmatch(txt, mtch.end()):
+                    raise ValueError("No escaped character") # shlex hits EOF in the escape first;
+                raise ValueError("No closing quotation")
+            if ("'" not in token) and ('"' not in token) and ("\\" not in token):
+                tokens.append(token)
+                continue
+            parts = [ ]
+            for single, double, escaped, bare in Expander.SHLEX_PART_REX.findall(token):
+                # findall gives "" for groups that didn't take part, bare/escaped are never empty when matched;
+                if bare or escaped:
+                    parts.append(bare or escaped)
+                elif double:
+                    parts.append(Expander.SHLEX_DQ_ESCAPE_REX.sub(r'\1', double))
+                else:
+                    parts.append(single)
+            tokens.append("".join(parts))
+        return tokens
+
+    TOKENIZERS = dict(shlex=shlex.split, regex=rex_shlex.__func__)
 
     @staticmethod
     def tokenize_static(txt, **kwa):
-        "The globally available tokenizer;"
-        # splitter = Expander.rex_shlex
-        splitter = shlex.split
+        "The globally available tokenizer; tokenizer= picks 'shlex' (default), 'regex' or a callable;"
+        splitter = kwa.get('tokenizer', None) or 'shlex'
+        if not callable(splitter):
+            splitter = Expander.TOKENIZERS[splitter]
         translation = kwa.get('translation', None)
         pattern = kwa.get('pattern', None)
         if pattern:
@@ -641,7 +2227,7 @@ class Expander():
         if translation:
             translated_tokens = [ ]
             for token in tokens:
-                token.replace(translation[0], translation[1])
+                token = token.replace(translation[0], translation[1])
                 translated_tokens.append(token)
         else:
             return tokens
@@ -649,27 +2235,50 @@ class Expander():
 
     def tokenize(self, txt, **kwa):
         "The instance-available tokenizer;"
+        kwa.setdefault('tokenizer', self._tokenizer)
+        if self._stats is not None:
+            with self._stats.phase('tokenize'):
+                tokens = Expander.tokenize_static(txt, **kwa)
+            self._stats.count('tokens', len(tokens))
+            return tokens
         return Expander.tokenize_static(txt, **kwa)  # For now...
 
+    @staticmethod
+    def template_cache_info():
+        "lru_cache statistics for the shared compiled-Template cache;"
+        return _compile_template.cache_info()
+
+    @staticmethod
+    def template_cache_clear():
+        _compile_template.cache_clear()
+
     @property
     def error(self):
         return self._error
     
     @property
     def globals(self):
-        return self._globals_first[0]
+        return self._scopes[0]
 
     @property
     def helpers(self):
         return self._helpers
 
+    @property
+    def scanner(self):
+        return _scanner(self._start, self._end)
+
     @property
     def locals(self):
-        return self._locals_first[0]
+        return self._scopes[-1]
 
 if __name__ == "__main__":
     "Test suite;"
+    import datetime
+    import random
     import sys
+    import tempfile
+    import threading
 
     def cli_get_args():
         pname, *args = sys.argv
@@ -694,6 +2303,148 @@ if __name__ == "__main__":
         # print(ostr)
         return directives
 
+    def test_stream(include_fn):
+        def directives(df):
+            result = [ ]
+            for ln in df.trim_iter():
+                tokens = re.split(r'\s+', ln)
+                if tokens[0].lower() == 'include':
+                    df.insert_trimmed(DynaFile(tokens[1], stream=True).trimmed)
+                result.append(ln)
+            return result
+        assert directives(DynaFile(include_fn, stream=True)) == test_dynafile_include(include_fn)
+        with tempfile.NamedTemporaryFile('w', suffix='.i') as tfd:
+            tfd.write("one \\\n  two # comment\n\n   # only a comment\nthree\n")
+            tfd.flush()
+            eager = DynaFile(tfd.name, continuation="\\")
+            streamed = DynaFile(tfd.name, continuation="\\", stream=True)
+            assert list(streamed.trim_iter()) == eager.trimmed == [ "one two", "three" ]
+
+    def test_mmap(include_fn):
+        eager, mapped = DynaFile(include_fn), DynaFile(include_fn, mmap=True)
+        assert len(mapped) == len(eager)
+        assert mapped[-1] == eager[-1] and mapped[1:3] == eager[1:3]
+        assert list(mapped.trim_iter()) == eager.trimmed
+        mapped.close()
+        mapped, streamed = DynaFile(include_fn, mmap=True), DynaFile(include_fn, stream=True)
+        for ln, sln in zip(mapped.trim_iter(), streamed.trim_iter()):
+            assert mapped.current_text == ln == sln == streamed.current_text
+        assert [ ln for ln in mapped ] == eager.all
+        mapped.close()
+
+    def test_piece_table():
+        rng = random.Random(5)
+        table, reference = PieceTable(list(range(50))), list(range(50))
+        for n in range(500):
+            where = rng.randint(0, len(reference))
+            drop = rng.randint(0, 3)
+            newdata = [ f"{n}.{i}" for i in range(rng.randint(0, 4)) ]
+            table.splice(where, newdata, drop)
+            reference[where:where + drop] = newdata
+            i = rng.randrange(len(reference))
+            assert table[i] == reference[i] and len(table) == len(reference)
+        assert table == reference and table[-3:] == reference[-3:]
+        raw = [ "a", "# comment", "b \\", "c", "", "d" ]
+        with tempfile.NamedTemporaryFile('w', suffix='.i') as tfd:
+            tfd.write("\n".join(raw) + "\n")
+            tfd.flush()
+            df = DynaFile(tfd.name, continuation="\\")
+            df.insert_raw(4, [ "x # trailing", "y" ])
+            df.append("z")
+            assert df.trimmed == [ "a", "b c", "x", "y", "d", "z" ]
+            assert df.all == raw[:4] + [ "x # trailing", "y" ] + raw[4:] + [ "z" ]
+            for n in range(300):            # Inserts land where trimming the whole raw file would put them;
+                where = rng.randint(4, len(df.all)) # Past "b \" + "c": inserts between them aren't joined;
+                df.insert_raw(where, rng.choice([ [ f"n{n}" ], [ "# c", f"m{n} # t" ], [ "" ] ]))
+                assert list(df.trimmed) == df.trim(list(df.all)), where
+        weighed = PieceTable(list(range(10)))
+        weighed.weigh(lambda piece: sum(piece[0][piece[1]:piece[2]]))
+        weighed.splice(4, [ 100 ])
+        assert weighed.weight_to(5) == 0 + 1 + 2 + 3 + 100 and weighed.weight_to(11) == 145 and weighed.weight_to(0) == 0
+
+    def test_include_engine():
+        with tempfile.TemporaryDirectory() as tdir:
+            def write(fn, *lines):
+                with open(os.path.join(tdir, fn), 'w') as ofd:
+                    ofd.write("\n".join(lines) + "\n")
+            write("top.i", "first", "include header.i", "middle # comment", "include header.i", "include leaf.i", "last")
+            write("header.i", "h1", "include leaf.i", "h2")
+            write("leaf.i", "leaf")
+            write("loop.i", "include again.i")
+            write("again.i", "include loop.i")
+            expected = [ "first", "h1", "leaf", "h2", "middle", "h1", "leaf", "h2", "leaf", "last" ]
+            top = os.path.join(tdir, "top.i")
+            DynaFile._include_cache.clear()
+            eager = DynaFile(top, include_directive='include', search_dirs=[ tdir ])
+            assert list(eager.trim_iter()) == expected
+            assert DynaFile._include_cache.misses == 2
+            streamed = DynaFile(top, include_directive='include', search_dirs=[ tdir ], stream=True)
+            assert list(streamed.trim_iter()) == expected
+            assert DynaFile._include_cache.misses == 2
+            for stream in [ False, True ]:
+                DynaFile._include_cache.clear()
+                prefetched = DynaFile(top, include_directive='include', search_dirs=[ tdir ], stream=stream, prefetch=4)
+                assert DynaFile._include_cache.misses == 2
+                assert list(prefetched.trim_iter()) == expected
+                assert DynaFile._include_cache.misses == 2
+            for stream in [ False, True ]:
+                try:
+                    df = DynaFile(os.path.join(tdir, "loop.i"), include_directive='include', search_dirs=[ tdir ], stream=stream)
+                    list(df.trim_iter())
+                    assert False, "include cycle not detected"
+                except IncludeCycleError as e:
+                    pass
+            write("spliced.i", "a", "include two.i", "# comment", "b")
+            write("two.i", "L1", "L2")
+            df = DynaFile(os.path.join(tdir, "spliced.i"), include_directive='include', search_dirs=[ tdir ])
+            df.append("z")
+            assert list(df.trimmed) == [ "a", "L1", "L2", "b", "z" ], list(df.trimmed)
+            df.insert_raw(3, [ "NEW", "# c", "NEW2" ])  # Before "b", after the comment;
+            df.insert_raw(1, [ "first" ])               # Before the include line;
+            df.insert_raw(3, [ "after" ])               # Right after it;
+            assert list(df.trimmed) == [ "a", "first", "L1", "L2", "after", "NEW", "NEW2", "b", "z" ], list(df.trimmed)
+
+    def test_resolver():
+        with tempfile.TemporaryDirectory() as tdir:
+            first, second = os.path.join(tdir, "first"), os.path.join(tdir, "second")
+            os.mkdir(first)
+            os.mkdir(second)
+            with open(os.path.join(second, "inc.i"), 'w') as ofd:
+                ofd.write("second\n")
+            resolver = IncludeResolver(check_mtime=True)
+            dirs = [ first, second ]
+            for n in range(3):
+                assert resolver.resolve("inc.i", dirs) == os.path.join(second, "inc.i")
+                assert resolver.resolve("nope.i", dirs) == False
+            stats = resolver.stats()
+            assert stats['hits'] == 4 and stats['negative_hits'] == 2 and stats['stat_calls_saved'] > 0
+            with open(os.path.join(first, "inc.i"), 'w') as ofd:
+                ofd.write("first\n")
+            os.utime(first, ns=( 1, 1 )) # Make sure the dir mtime visibly changes;
+            assert resolver.resolve("inc.i", dirs) == os.path.join(first, "inc.i")
+            now = [ 0 ]
+            expiring = IncludeResolver(ttl=10, clock=lambda: now[0])
+            expiring.resolve("inc.i", dirs)
+            now[0] = 11
+            expiring.resolve("inc.i", dirs)
+            assert expiring.hits == 0
+            top = os.path.join(tdir, "top.i")
+            with open(top, 'w') as ofd:
+                ofd.write("include late.i\n")
+            kwa = dict(include_directive='include', search_dirs=[ first ])
+            try:
+                DynaFile(top, **kwa)
+                assert False, "late.i found before it exists"
+            except FileNotFoundError:
+                pass
+            with open(os.path.join(first, "late.i"), 'w') as ofd:
+                ofd.write("late\n")
+            os.utime(first, ns=( 2, 2 ))
+            assert list(DynaFile(top, **kwa).trimmed) == [ "late" ]  # The shared resolver's miss isn't kept;
+            os.remove(os.path.join(first, "late.i"))
+            os.utime(first, ns=( 3, 3 ))
+            assert DynaFile._resolver.resolve("late.i", [ first ]) == False
+
     def test_dereferencer():
         globals_ = dict(ga="A", gb="B", gc="C", a="GA", b="BG", V="4:04")
         middles_ = dict(a="middle a", b="mid b", c="mid-c")
@@ -704,8 +2455,300 @@ if __name__ == "__main__":
         assert xp.outermost('a') == 'GA'
         assert xp['V'] == '4:04'
 
+    def test_scope_stack():
+        rng = random.Random(11)
+        walked, flat = Expander(dict(g="global")), Expander(dict(g="global"), flatten=True)
+        for n in range(2000):
+            op, k = rng.choice([ 'push', 'pop', 'set', 'set', 'get' ]), rng.choice("abcdeg")
+            for xp in [ walked, flat ]:
+                if op == 'push':
+                    xp.push_scope({ k: f"pushed {n}" })
+                elif op == 'pop' and len(xp._scopes) > 1:
+                    xp.pop_scope()
+                elif op == 'set':
+                    xp[k] = n
+            assert walked.get(k) == flat.get(k) and (k in walked) == (k in flat)
+        assert flat.outermost('g') == walked.outermost('g') and flat.innermost('g') == walked['g']
+        flat.globals['late'] = "external"
+        flat.touch(0)
+        assert flat['late'] == "external"
+        xp = Expander()
+        xp['x'] = "local"
+        xp.push_scope()
+        xp['x'] = "inner"
+        assert xp.local_scope('x') == "inner" and xp.outermost('x') == "local"
+        xp.pop_scope()
+        assert xp['x'] == "local"
+
+    def test_fork():
+        parent = Expander(dict(g="global"))
+        child = parent.fork(dict(l="local"))
+        assert child.helpers is parent.helpers and child['g'] == "global" and child['l'] == "local"
+        child['g'] = "shadowed"
+        assert parent['g'] == "global" and child.outermost('g') == "global"
+        nsxp = Expander(namespaces=dict(default=dict(a="A")), start="{{", end="}}")
+        req = nsxp.fork(request=dict(id="42"))
+        assert req.expand("{{a}}/{{request:id}}") == "A/42" and 'request:id' not in nsxp
+        assert Expander(start="{{", end="}}").helpers is nsxp.helpers
+
+    def test_recursive():
+        xp = Expander(dict(root="/opt", bin="{root}/bin", tool="{bin}/tool", quoted='"{tool}" -v', n=[ 1, 2 ]))
+        assert xp.expand("run {tool} {~n} {nope}") == "run /opt/bin/tool 2 {nope}"
+        assert xp.expand_token("{quoted}") == '"/opt/bin/tool" -v'
+        assert Expander(dict(a="{b}", b="B"), recursive=False).expand("{a}") == "{b}"
+        chain = { f"v{n}": f"{{v{n + 1}}}+" for n in range(3000) }
+        chain['v3000'] = "end"
+        assert Expander(chain).expand("{v0}") == "end" + "+" * 3000
+        xp['root'] = "{tool}"
+        try:
+            xp.expand("{bin}")
+            assert False, "cycle not caught"
+        except ExpansionCycleError as e:
+            assert "bin -> root -> tool -> bin" in str(e), e
+        nsxp = Expander(namespaces=dict(default=dict(a="{o:b}.{o:b}"), o=dict(b="B{~o:c}", c="xyz")), output_cache=4)
+        assert nsxp.expand("{a}") == "B3.B3"
+        nsxp['o:c'] = "wxyz"                        # Only read inside a's value, the cache still has to notice;
+        assert nsxp.expand("{a}") == "B4.B4"
+        scoped = Expander(dict(inner="{outer}", outer="old"), dict(x="{inner}"), output_cache=4)
+        assert scoped.expand("{x}") == "old"
+        scoped.globals['outer'] = "new"
+        scoped.touch(0)
+        assert scoped.expand("{x}") == "new"
+
+    def test_bulk_load():
+        with tempfile.TemporaryDirectory() as tmpdir:
+            files = dict(vars="a\tEh?\n\n# comment\nspaced   two words \nrec.x\t1\nrec.y\t2\nempty\n",
+                         json='{"a": "jay", "rec": {"x": 1, "z": [ 1, 2 ]}}',
+                         ini="top = 1\n[rec]\nX = ex\nurl = http://h/%(p)s\n  more\n; note\n[other]\nk: v=w\n")
+            paths = { }
+            for fmt, text in files.items():
+                paths[fmt] = os.path.join(tmpdir, f"cfg.{fmt}")
+                with open(paths[fmt], 'w') as ofd:
+                    ofd.write(text)
+            assert Expander.read_vars(paths['vars']) == { 'a': "Eh?", 'spaced': "two words", 'rec.x': "1",
+                                                          'rec.y': "2", 'empty': "" }
+            xp = Expander(namespaces=dict(default=dict(keep=1)), output_cache=4)
+            xp.load('cfg', paths['vars'])
+            assert xp['cfg:rec.x'] == "1" and xp['~cfg:rec'] == "2" and xp['cfg:spaced'] == "two words"
+            xp.load('cfg', paths['json'])           # Merges into rec's fields, replaces a;
+            assert xp['cfg:a'] == "jay" and xp['cfg:rec.x'] == "1" and xp['cfg:rec.y'] == "2" and xp['~cfg:rec.z'] == "2"
+            xp.load('ini', paths['ini'])
+            assert xp['ini:rec.X'] == "ex" and xp['ini:rec.url'] == "http://h/%(p)s\nmore" and xp['ini:top'] == "1"
+            assert xp['ini:other.k'] == "v=w"
+            assert xp.expand("{cfg:rec.y}") == "2"
+            xp.update('default', { 'keep': 2, 'f.g': "G" })
+            assert xp.expand("{cfg:rec.y} {keep} {f.g}") == "2 2 G" and xp.output_cache_info()['invalidations'] == 0
+        safe = Expander(namespaces=dict(default=dict(f=dict(a=1))), threadsafe=True)
+        before = safe._namespaces['default']['f']
+        safe.update('default', { 'f.b': 2, 'v': 3 })
+        assert safe['f.b'] == "2" and safe['f.a'] == "1" and safe['v'] == 3 and before == dict(a=1)
+        for threadsafe in [ False, True ]:
+            scoped = Expander(dict(g=1), dict(l=1), flatten=True, threadsafe=threadsafe)
+            assert scoped['g'] == 1
+            scoped.update(0, dict(g=2, h=3))
+            scoped.update(-1, dict(l=2))
+            assert ( scoped['g'], scoped['h'], scoped['l'] ) == ( 2, 3, 2 )
+
+    def test_provider():
+        now = [ 0.0 ]
+        calls = [ ]
+        def computed(var):
+            calls.append(var)
+            if not var.startswith("sq"):
+                raise KeyError(var)
+            return int(var[2:]) ** 2
+        class Secrets(Provider):
+            def load(self, var, field = None):
+                if var != "db":
+                    raise KeyError(var)
+                return dict(user="svc", password="hunter2")[field] # Only the field asked for is fetched;
+        sq = Provider(computed, ttl=10, clock=lambda: now[0])
+        xp = Expander(namespaces=dict(env=Provider.environ(), sq=sq, secret=Secrets()), output_cache=8)
+        assert xp['env:USER'] == os.environ['USER'] and 'env:NO_SUCH_VAR_REALLY' not in xp
+        assert xp.expand("{sq:sq4} {sq:sq4} {secret:db.user}") == "16 16 svc" and calls == [ "sq4" ]
+        assert xp['sq:sq4'] == "16" and 'sq:nope' not in xp and calls == [ "sq4", "nope" ]
+        now[0] = 11.0
+        assert xp.value('sq:sq4') == 16 and calls[-1] == "sq4" and sq.stats()['loads'] == 2
+        xp['sq:sq4'] = "set"
+        xp['secret:db.password'] = "stub"
+        assert xp.expand("{sq:sq4} {secret:db.password} {secret:db.user}") == "set stub svc"
+        assert xp.get('secret:nope.user', "dflt") == "dflt" and xp.output_cache_info()['entries'] == 0
+        memo = Expander(namespaces=dict(p=Provider(computed)), output_cache=8)
+        assert memo.expand("{p:sq3}") == "9" and memo.expand("{p:sq3}") == "9"
+        memo._namespaces['p'].invalidate()
+        memo['p:sq3'] = 0
+        assert memo.expand("{p:sq3}") == "0" and memo.output_cache_info()['invalidations'] == 1
+
+    def test_typed():
+        xp = Expander(dict(frame=7, items=[ 1, 2, 3 ], pi="3.14159", out="{dir}/f{frame:04d}", dir="/tmp"))
+        assert xp.expand_typed("{frame}") == 7 and xp.expand_typed("{items}") == [ 1, 2, 3 ]
+        assert xp.expand_typed("{~items}") == 3 and xp.value('~items') == 3 and xp.value('frame:04d') == "0007"
+        assert xp.expand_typed("f{frame:04d}.png {pi:.2f} {frame:>3} {nope}") == "f0007.png 3.14   7 {nope}"
+        assert xp.expand_typed("{out}") == "/tmp/f{frame:04d}"   # Values are expanded by the plain rules;
+        assert xp.expand("{frame:-unset} {frame}") == "{frame:-unset} 7" and xp.value('nope', None) is None
+        assert xp.expand_typed("{frame:-unset}") == "{frame:-unset}" and xp.expand_typed("{frame:-unset} {frame}") == "{frame:-unset} 7"
+        dated = Expander(dict(host="example.com", when=datetime.date(2024, 5, 6)))
+        assert dated.expand_typed("{host:x}") == "{host:x}" and dated.expand("{host:x}") == "{host:x}"
+        assert dated.expand_typed("{when:%Y-%m-%d}") == "2024-05-06" and dated.expand_typed("at {when:%d/%m}") == "at 06/05"
+        nsxp = Expander(namespaces=dict(default=dict(frame="3", rec=dict(t=2.5)), env=dict(n=12)))
+        assert nsxp.expand_typed("{env:n}") == 12 and nsxp.expand_typed("{env:n:>4}|{frame:03d}") == "  12|003"
+        assert nsxp.expand_typed("{rec.t:.3f} {default:frame:02d}") == "2.500 03" and nsxp.value('rec.t') == 2.5
+        assert Expander.parse_key('~a') == VarRef('~a', 'a', 'simple', 'default', 'a', None, True)
+        assert xp.format('pi') == "3.14159" and Expander(dict(v="3.14159:.2f")).format('v') == "3.14"
+
+    def test_limits():
+        laughs = { "lol0": "lol" }
+        for n in range(1, 10):
+            laughs[f"lol{n}"] = " ".join([ f"{{lol{n - 1}}}" ] * 10)
+        for limit, bound, name in [ ( 'max_output', 10 ** 5, 'lol5' ), ( 'max_substitutions', 50, 'lol6' ),
+                                    ( 'max_depth', 3, 'lol6' ), ( 'time_budget', 0.0, 'lol9' ) ]:
+            xp = Expander(laughs, limits=ExpansionLimits(**{ limit: bound }))
+            try:
+                xp.expand("{lol9}")
+                assert False, f"{limit} not enforced"
+            except ExpansionLimitError as e:
+                assert ( e.limit, e.bound, e.name ) == ( limit, bound, name ), e
+        xp = Expander(laughs, limits=ExpansionLimits(max_output=400, max_substitutions=200, max_depth=2))
+        assert xp.expand("{lol2}") == " ".join([ "lol" ] * 100) and xp.expand_token("{lol1}") == xp.expand("{lol1}")
+        try:
+            xp.expand_token("{lol2}{lol2}")
+            assert False, "expand_token output not limited"
+        except ExpansionLimitError as e:
+            assert e.limit == 'max_output', e
+        xp = Expander(laughs, limits=ExpansionLimits(max_output=10000))
+        try:
+            xp.value('lol7')
+            assert False, "value() not limited"
+        except ExpansionLimitError as e:
+            assert ( e.limit, e.name ) == ( 'max_output', 'lol4' ), e
+
+    def test_output_cache():
+        nsxp = Expander(namespaces=dict(default=dict(a="A"), other=dict(b="B")), output_cache=8)
+        assert nsxp.expand("echo {a}") == "echo A" and nsxp.expand("echo {a}") == "echo A"
+        nsxp['other:b'] = "b2"                      # Not read by "echo {a}", so still a hit;
+        assert nsxp.expand("echo {a}") == "echo A"
+        nsxp['a'] = "A2"
+        assert nsxp.expand("echo {a} {other:b}") == "echo A2 b2" and nsxp.expand("echo {a}") == "echo A2"
+        info = nsxp.output_cache_info()
+        assert ( info['hits'], info['misses'], info['invalidations'] ) == ( 2, 3, 1 ), info
+        nsxp._namespaces['default']['a'] = "behind"  # Behind the Expander's back, so unseen until touch();
+        assert nsxp.expand("echo {a}") == "echo A2"
+        nsxp.touch('default')
+        assert nsxp.expand("echo {a}") == "echo behind"
+        scoped = Expander(dict(g="global", x="outer"), output_cache=8)
+        scoped.push_scope(dict(y="inner"))
+        assert scoped.expand("{g} {x}") == "global outer"
+        scoped['z'] = 1                             # Written inside the scope the values came from;
+        assert scoped.expand("{g} {x}") == "global outer" and scoped.output_cache_info()['invalidations'] == 1
+        assert scoped.expand("{g} {x}") == "global outer" and scoped.output_cache_info()['hits'] == 1
+        scoped['x'] = "shadowed"
+        assert scoped.expand("{g} {x}") == "global shadowed"
+        scoped.pop_scope()
+        assert scoped.expand("{g} {x}") == "global outer" and scoped.expand("{nope}") == "{nope}"
+        before = scoped.output_cache_info()
+        child = scoped.fork(dict(x="child"))
+        assert child.expand("{g} {x}") == "global child" and child.output_cache_info()['hits'] == 0
+        assert scoped.expand("{g} {x}") == "global outer"   # Forking doesn't invalidate the parent's cache;
+        after = scoped.output_cache_info()
+        assert after['hits'] == before['hits'] + 1 and after['invalidations'] == before['invalidations'], after
+        scoped['g'] = "changed"                     # The parent's innermost scope sits outside the child's;
+        assert child.expand("{g} {x}") == "changed child"
+        plain = Expander(dict(x=1))
+        assert plain.output_cache_info() is None and plain.expand("{x}") == "1"
+
+    def test_stats():
+        events = [ ]
+        xp = Expander(namespaces=dict(default=dict(a="A", b="{a}{ns:c}", f=dict(x=1)), ns=dict(c="C")),
+                      hook=lambda kind, name, value: events.append(( kind, name )))
+        assert xp.expand("echo {b} {f.x} {ns:c} {~a}") == "echo AC 1 C 1"
+        assert xp.get("ns:nope", "dflt") == "dflt" and xp.get("missing:x", "dflt") == "dflt"
+        stats = xp.stats()
+        counts = stats['counts']
+        assert ( counts['refs.simple'], counts['refs.fielded'], counts['refs.namespaced'] ) == ( 3, 1, 2 ), counts
+        assert counts['misses.ns'] == 1 and counts['misses.missing'] == 1, counts
+        assert stats['calls']['compile'] == stats['calls']['render'] == 1 and stats['times']['render'] >= 0
+        assert ( 'count', 'misses.ns' ) in events and ( 'time', 'render' ) in events
+        assert xp.expand_tokens("x", "{a}") == [ "x", "A" ] and xp.stats()['counts']['refs.simple'] == 4
+        assert xp.fork().stats()['counts']['refs.simple'] == 4   # Forks share their parent's Stats;
+        shared = Stats()
+        scoped = Expander(dict(g="G"), stats=shared)
+        assert scoped.tokenize("a b 'c d'") == [ "a", "b", "c d" ] and scoped.expand("{g} {nope}") == "G {nope}"
+        counts = shared.snapshot()['counts']
+        assert counts['tokens'] == 5 and counts['misses.scopes'] == 1 and counts['refs.simple'] == 2, counts
+        assert Expander(dict(x=1)).stats() is None and DynaFile(__file__).stats() is None
+        with tempfile.TemporaryDirectory() as tdir:
+            for fn, lines in dict(top=[ "a", "include leaf.i", "# c", "include leaf.i" ], leaf=[ "b" ]).items():
+                with open(os.path.join(tdir, f"{fn}.i"), 'w') as ofd:
+                    ofd.write("\n".join(lines) + "\n")
+            top = os.path.join(tdir, "top.i")
+            for stream in [ False, True ]:
+                DynaFile._include_cache.clear()
+                df = DynaFile(top, include_directive='include', search_dirs=[ tdir ], stream=stream, stats=shared)
+                assert list(df.trim_iter()) == [ "a", "b", "b" ]
+                counts = df.stats()['counts']
+                assert counts['includes'] == 2 + 2 * stream and counts['include_cache.misses'] == 1 + stream, counts
+            counts, calls = shared.snapshot()['counts'], shared.snapshot()['calls']
+            assert counts['files'] == 4 and counts['bytes'] == 2 * (os.path.getsize(top) + 2), counts
+            assert counts['include_cache.hits'] == 1 and calls['read'] == calls['trim'] == calls['includes'] == 1
+            shared.reset()
+            DynaFile._include_cache.clear()
+            df = DynaFile(top, include_directive='include', search_dirs=[ tdir ], prefetch=True, stats=shared)
+            assert list(df.trimmed) == [ "a", "b", "b" ]
+            counts = shared.snapshot()['counts']   # Prefetching resolves includes too, but counts them apart;
+            assert counts['includes'] == 2 and counts['prefetch.includes'] == 2, counts
+            shared.reset()
+            assert shared.snapshot() == dict(counts={ }, times={ }, calls={ })
+
+    def test_threads():
+        switch = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        errors, done = [ ], threading.Event()
+        nsxp = Expander(namespaces=dict(default=dict(a=0, b="const")), threadsafe=True, output_cache=16)
+        scoped = Expander(dict(g="global", x=0), threadsafe=True, flatten=True)
+        def writer():
+            for n in range(3000):
+                nsxp['a'] = n
+                nsxp['aux:v.f'] = n
+                scoped.push_scope(dict(x=n))
+                scoped['x'] = -n
+                scoped.pop_scope()
+            done.set()
+        def reader(i):
+            helper = nsxp.helpers['DEEP']
+            token = f"ns{i}:var{i}.field{i}"
+            try:
+                while not done.is_set():
+                    left, right, b = nsxp.expand("{a}|{a} {b}").replace(" ", "|").split("|")
+                    assert left == right and b == "const", f"{left} {right} {b}"
+                    first, second = scoped.expand("{x}:{x}:{g}").split(":")[:2]
+                    assert first == second and scoped['g'] == "global"
+                    assert helper.match(token).groups() == ( token, f"ns{i}", f"var{i}", f"field{i}" )
+            except Exception as e:
+                errors.append(e)
+        threads = [ threading.Thread(target=reader, args=( i, )) for i in range(6) ]
+        threads.append(threading.Thread(target=writer))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        shared = Expander(dict(a="A", b="B"), output_cache=4)   # Read-only renders don't need threadsafe=True;
+        def render():
+            try:
+                for n in range(2000):
+                    assert shared.expand(f"{{a}} {n % 10} {{b}}") == f"A {n % 10} B"
+            except Exception as e:
+                errors.append(e)
+        threads = [ threading.Thread(target=render) for i in range(6) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        sys.setswitchinterval(switch)
+        assert not errors, errors[0]
+        assert nsxp['a'] == 2999 and nsxp['aux:v.f'] == "2999" and scoped['x'] == 0
+
     def test_deref_ns():
-        env = dict(os.environ)
+        env = Provider.environ()
         default = dict(a="def a", b="def b", c="def c")
         aux = dict(a="aux a", b="aux b", c="aux c", v1=1)
         fielded = dict(a=dict(thing_1 = "thing one", thing_2 = "thing_the_second"))
@@ -718,6 +2761,23 @@ if __name__ == "__main__":
         xp['fielded:a.thing_3'] = "3rd_of_things"
         assert xp['~fielded:a'] == "3"
 
+    def test_key_cache():
+        xp = Expander(namespaces=dict(default=dict(a=1, f=dict(x="ex")), aux=dict(v="vee")))
+        assert xp['a'] == 1 and xp['f.x'] == "ex" and xp['aux:v'] == "vee" and xp['~aux:v'] == "3"
+        assert 'aux:v' in xp and 'aux:nope' not in xp and 'nons:v' not in xp and 'f.nope' not in xp
+        assert xp.get('aux:nope', "dflt") == "dflt" and xp.get('f.x') == "ex"
+        xp['new:var.field'] = "deep"
+        xp['aux:w'] = "dub"
+        assert xp['new:var.field'] == "deep" and xp['~new:var'] == "1" and xp['aux:w'] == "dub"
+        hits = Expander.key_cache_info().hits
+        for n in range(10):
+            assert xp['new:var.field'] == "deep"
+        assert Expander.key_cache_info().hits >= hits + 10
+        xp['new-key'] = 3
+        xp._namespaces['default']['x y'] = "spaced"
+        assert xp['new-key'] == 3 and xp['x y'] == "spaced" and 'new-key' in xp and xp.get('x y') == "spaced"
+        assert Expander.parse_key('~ns:var.field') == VarRef('~ns:var.field', 'ns:var.field', 'deep', 'ns', 'var', 'field', True)
+
     def test_expand_file(src_fn):
         # >>> xp = Expander(global_dict, local_dict)
         #     s = xp("{foo}")
@@ -778,7 +2838,7 @@ if __name__ == "__main__":
     def test_expander():
         fields = dict(x="Ecks", y="Why", z="Eh?", b="bee", c="see", third="3rd")
         x = dict(a=fields, b="Befoo", c="Sifu")
-        env, dflt = dict(os.environ), dict(a="Ahey", b="bee", c="see", third="3rd")
+        env, dflt = Provider.environ(), dict(a="Ahey", b="bee", c="see", third="3rd")
         xp = Expander(namespaces=dict(env=env, default=dflt, x=x), start="{{", end="}}")
         s1 = "this is a string with {{x:a.z}}-{{b}}--{{~c}}: {{env:USER}}"
         tstr = "this is a string with Eh?-bee--3:"
@@ -786,6 +2846,47 @@ if __name__ == "__main__":
         # print(ostr)
         assert ostr.startswith(tstr)
 
+    def test_template_cache():
+        dflt, aux = dict(a="A", b="B", c="sea"), dict(x=dict(y="Why"))
+        xp = Expander(namespaces=dict(default=dflt, aux=aux))
+        line = 'echo {a}-{b} "quoted {aux:x.y}" {~c} {a}'
+        assert xp.expand(line) == "echo A-B quoted Why 3 A"
+        hits = Expander.template_cache_info().hits
+        xp['a'] = "Ay"
+        assert xp.expand(line) == "echo Ay-B quoted Why 3 Ay"
+        assert Expander.template_cache_info().hits == hits + 1
+        scoped = Expander(dict(a="global a"), dict(b="local b"))
+        assert scoped.expand("{a} {b} {missing}") == "global a local b {missing}"
+
+    def test_scanner():
+        xp = Expander(namespaces=dict(default=dict(a="A", b="B", d=dict(e="E")), ns=dict(v=dict(f="F"), w="W")))
+        token = "{a}-{ b }-{ns:w}{d.e}/{ns:v.f}{~a}{a}{x-y}"
+        legacy = set()
+        for helper in [ 'SIMPLE', 'NAMESPACED', 'FIELDED', 'DEEP' ]:
+            legacy |= set(( full, core ) for full, core, *others in xp.helpers[helper].findall(token))
+        assert set(xp._find_subtokens(token)) == legacy
+        kinds = [ ref.kind for literal, ref in xp.scanner.scan(token) if ref ]
+        assert kinds == [ 'simple', 'simple', 'namespaced', 'fielded', 'deep', 'simple', 'simple' ]
+        assert xp.expand_token(token) == "A-B-WE/F1A{x-y}"
+
+    def test_rex_shlex(include_fn):
+        cases = [ "", "  plain   words\there ", "a'b c'd", 'say "a \\"quoted\\" \\\\ \\x word"',
+                  "esc\\ aped \\'q\\'", "'' \"\" x''y", "'it''s' \"#\" # {x:a.z}-{{b}}",
+                  "mixed'single \\ \"'\"dq 'sq'\"", "trailing\\\\" ]
+        with open(include_fn) as ifd:
+            cases += [ ln for ln in ifd ]
+        for case in cases:
+            assert Expander.rex_shlex(case) == shlex.split(case), case
+        for bad in [ 'open "quote', "open 'quote", "dangling\\", 'a"b' ]:
+            for splitter in [ shlex.split, Expander.rex_shlex ]:
+                try:
+                    splitter(bad)
+                    assert False, f"{bad} should not tokenize"
+                except ValueError as e:
+                    pass
+        xp = Expander(dict(a="A"), tokenizer='regex')
+        assert xp.tokenize('x "y z"') == [ "x", "y z" ] and xp.expand('{a} "{a} b"') == "A A b"
+
     def test_tokenizer():
         s1 = "this is a string with {{x:a.z}}-{{b}}--{{c}}"
         tokens = Expander.tokenize_static(s1)
@@ -802,12 +2903,50 @@ if __name__ == "__main__":
         include_fn = args.pop(0)
         print(f"test_dynafile_include({include_fn})")
         directives = test_dynafile_include(include_fn)
+        print(f"test_stream({include_fn})")
+        test_stream(include_fn)
+        print(f"test_mmap({include_fn})")
+        test_mmap(include_fn)
+        print("test_piece_table()")
+        test_piece_table()
+        print("test_include_engine()")
+        test_include_engine()
+        print("test_resolver()")
+        test_resolver()
         print("test_tokenizer()")
         test_tokenizer()
+        print(f"test_rex_shlex({include_fn})")
+        test_rex_shlex(include_fn)
+        print("test_scanner()")
+        test_scanner()
+        print("test_template_cache()")
+        test_template_cache()
         print("test_dereferencer()")
         test_dereferencer()
+        print("test_scope_stack()")
+        test_scope_stack()
+        print("test_fork()")
+        test_fork()
+        print("test_recursive()")
+        test_recursive()
+        print("test_bulk_load()")
+        test_bulk_load()
+        print("test_provider()")
+        test_provider()
+        print("test_typed()")
+        test_typed()
+        print("test_limits()")
+        test_limits()
+        print("test_output_cache()")
+        test_output_cache()
+        print("test_stats()")
+        test_stats()
+        print("test_threads()")
+        test_threads()
         print("test_deref_ns()")
         test_deref_ns()
+        print("test_key_cache()")
+        test_key_cache()
         if 'ns' in include_fn:
             print(f"test_expand_file_ns({include_fn})")
             test_expand_file_ns(include_fn)
@@ -0,0 +1,411 @@
+#!/bin/env python3
+
+"""Benchmarks for the dizzle hot paths, over seeded synthetic inputs;
+
+    python dizzle_bench.py [--lines 10000,100000] [--seed N] [--json out.json|-] [--compare old.json] [bench...]
+"""
+
+if True:
+    import inspect
+    import json
+    import os
+    import platform
+    import random
+    import shlex
+    import subprocess
+    import sys
+    import tempfile
+    import time
+    import timeit
+    from   dizzle import DynaFile, Expander
+    from   dizzle_fixer import Fixer
+
+SEED = 1234
+SIZES = ( 10000, 100000 )
+
+
+def make_script(fn, nlines, rng, include = None):
+    "A DSL script of nlines: vars, echo lines with references of every syntax, comments and blanks;"
+    with open(fn, 'w') as ofd:
+        for n in range(nlines):
+            pick = rng.random()
+            if include and n == nlines // 2:
+                ofd.write(f"include {include}\n")
+            elif pick < 0.1:
+                ofd.write("\n")
+            elif pick < 0.2:
+                ofd.write(f"# comment line {n}\n")
+            elif pick < 0.4:
+                ofd.write(f"global v{n % 10} value-{n}   # trailing comment\n")
+            else:
+                ofd.write(make_line(rng.randint(1, 8)) + "\n")
+    return fn
+
+
+def make_continued(fn, nlines, rng, continuation = "\\"):
+    "A script where most logical lines are continued over 2-6 physical ones;"
+    with open(fn, 'w') as ofd:
+        n = 0
+        while n < nlines:
+            parts = rng.randint(2, 6)
+            for p in range(parts - 1):
+                ofd.write(f"echo part{p} {{v{p}}} {continuation}\n")
+            ofd.write("end of logical line\n")
+            n += parts
+    return fn
+
+
+def make_include_tree(dirnm, depth, fanout, nlines, rng):
+    "Root script whose includes nest depth deep, fanout per file, nlines of script each; returns the root path;"
+    def make(name, level):
+        lines = [ make_line(rng.randint(0, 4)) for n in range(nlines) ]
+        if level < depth:
+            for k in range(fanout):
+                child = f"{name}_{k}"
+                make(child, level + 1)
+                lines.insert(rng.randint(0, len(lines)), f"include {child}.i")
+        with open(os.path.join(dirnm, f"{name}.i"), 'w') as ofd:
+            ofd.write("\n".join(lines) + "\n")
+    make("root", 0)
+    return os.path.join(dirnm, "root.i")
+
+
+def make_line(nrefs, start="{", end="}"):
+    "A line of literal words with nrefs references spread across the syntaxes;"
+    kinds = [ "v{n}", "ns:v{n}", "f{n}.x", "ns:f{n}.x" ]
+    words = [ "literal" ]
+    for n in range(nrefs):
+        words.append(start + kinds[n % len(kinds)].format(n=n % 10) + end + "-tail")
+    return " ".join(words)
+
+
+def make_expander(start="{", end="}"):
+    dflt = { f"v{n}": f"value{n}" for n in range(10) }
+    dflt.update({ f"f{n}": dict(x=f"field{n}") for n in range(10) })
+    ns = { f"v{n}": f"ns-value{n}" for n in range(10) }
+    ns.update({ f"f{n}": dict(x=f"ns-field{n}") for n in range(10) })
+    return Expander(namespaces=dict(default=dflt, ns=ns), start=start, end=end)
+
+
+def legacy_expand_token(xp, token):
+    "The pre-scanner path: four findall passes, a set union, then one str.replace per reference;"
+    found = set()
+    for helper in [ 'SIMPLE', 'NAMESPACED', 'FIELDED', 'DEEP' ]:
+        found |= set(xp.helpers[helper].findall(token))
+    for full, core, *others in found:
+        if core.startswith("~"):
+            v = str(len(xp[core[1:]]))
+        else:
+            v = xp.get(core, full)
+        token = token.replace(full, v)
+    return token
+
+
+def timed(fn, number):
+    "Best-of-5 seconds per call;"
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number
+
+
+def bench_scanner(number=2000):
+    "Compare the single-pass VarScanner against the legacy four-regex path;"
+    xp = make_expander()
+    results = [ ]
+    for nrefs in [ 0, 1, 10, 100 ]:
+        line = make_line(nrefs)
+        assert legacy_expand_token(xp, line) == xp.expand_token(line)
+        legacy = timed(lambda: legacy_expand_token(xp, line), number)
+        scanner = timed(lambda: xp.expand_token(line), number)
+        results.append(dict(name=f"expand_token/{nrefs}refs", legacy_us=legacy * 1e6,
+                            scanner_us=scanner * 1e6, speedup=legacy / scanner))
+    return results
+
+
+def bench_tokenizer(number=2000):
+    "Throughput of the compiled-regex tokenizer against shlex.split;"
+    lines = dict(plain="global name wook and some more plain words to split",
+                 quoted='echo {name} {nickname} "quote this:" # {name}-{nickname} "a quoted string"',
+                 escaped="local path 'single quoted' a\\ b \"dq \\\"esc\\\" text\" tail",
+                 long=" ".join([ 'word "two words" {ref}' ] * 40))
+    results = [ ]
+    for name, line in lines.items():
+        assert Expander.rex_shlex(line) == shlex.split(line)
+        legacy = timed(lambda: shlex.split(line), number)
+        regex = timed(lambda: Expander.rex_shlex(line), number)
+        results.append(dict(name=f"tokenize/{name}", shlex_us=legacy * 1e6, regex_us=regex * 1e6,
+                            speedup=legacy / regex, regex_mb_s=len(line) / regex / 1e6))
+    return results
+
+
+def bench_recursive(number=20):
+    "Nested expansion of a chain of variables, each value referring to the next (time per reference should stay flat);"
+    results = [ ]
+    for depth in [ 10, 100, 1000 ]:
+        chain = { f"v{n}": f"{{v{n + 1}}}+" for n in range(depth) }
+        chain[f"v{depth}"] = "end"
+        xp = Expander(chain)
+        per_call = timed(lambda: xp.expand("{v0}"), number)
+        results.append(dict(name=f"recursive/{depth}deep", us=per_call * 1e6, us_per_ref=per_call * 1e6 / depth))
+    return results
+
+
+def legacy_fix(fixer, s):
+    "The old Fixer.__call__ (no eval): findall then one str.replace per match, then the same again for expressions;"
+    import re
+    start, end = re.escape(fixer._start), re.escape(fixer._end)
+    for full, k in re.findall(rf"(?P<full>{start}(?P<var>\w+){end})", s):
+        s = s.replace(full, fixer[k])
+    for full, words in re.findall(rf"(?P<full>{start}(?P<words>.*?){end})", s):
+        s = s.replace(full, " ".join(fixer[w] if w in fixer else w for w in re.split(r'\s+', words)))
+    return s
+
+
+def bench_fixer(number=200):
+    "Fixer calls on long lines of repeated references: the single re.sub pass against the old replace loops;"
+    fixer = Fixer(**{ f"v{n}": f"value-{n}" for n in range(20) })
+    results = [ ]
+    for nrefs in [ 10, 100, 1000 ]:
+        line = " ".join(f"{{v{n % 20}}} {{v{n % 7} and v{n % 3}}} txt" for n in range(nrefs))
+        assert legacy_fix(fixer, line) == fixer(line)
+        legacy = timed(lambda: legacy_fix(fixer, line), number)
+        single = timed(lambda: fixer(line), number)
+        results.append(dict(name=f"fixer/{nrefs * 2}refs", legacy_us=legacy * 1e6, single_pass_us=single * 1e6,
+                            speedup=legacy / single))
+    return results
+
+
+def legacy_read_vars(fn):
+    "The old Fixer._load: one re.split per line;"
+    import re
+    with open(fn, 'r') as ifd:
+        return dict([ re.split(r'\s+', ln.strip(), 1) for ln in ifd.readlines() ])
+
+
+def bench_startup(number=3, nvars=20000):
+    "Populate a namespace with nvars var.field values: one xp[...] = v each, against load() from TSV, JSON and INI;"
+    pairs = { f"var{n // 4}.field{n % 4}": f"value {n}" for n in range(nvars) }
+    nested = { }
+    for k, v in pairs.items():
+        var, field = k.split(".")
+        nested.setdefault(var, { })[field] = v
+    results = [ ]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = dict(vars=os.path.join(tmpdir, "big.vars"), json=os.path.join(tmpdir, "big.json"),
+                     ini=os.path.join(tmpdir, "big.ini"))
+        with open(paths['vars'], 'w') as ofd:
+            ofd.writelines(f"{k}\t{v}\n" for k, v in pairs.items())
+        with open(paths['json'], 'w') as ofd:
+            json.dump(nested, ofd)
+        with open(paths['ini'], 'w') as ofd:
+            for var, fields in nested.items():
+                ofd.write(f"[{var}]\n" + "".join(f"{k} = {v}\n" for k, v in fields.items()))
+        def per_key():
+            xp = Expander(namespaces=dict(default={ }))
+            for k, v in legacy_read_vars(paths['vars']).items():
+                xp[f"cfg:{k}"] = v
+            return xp
+        legacy = timed(per_key, number)
+        results.append(dict(name=f"startup/per-key/{nvars}", ms=legacy * 1e3, us_per_var=legacy * 1e6 / nvars))
+        for fmt, path in paths.items():
+            def bulk():
+                xp = Expander(namespaces=dict(default={ }))
+                xp.load('cfg', path)
+                return xp
+            assert bulk()['cfg:var7.field2'] == per_key()['cfg:var7.field2']
+            elapsed = timed(bulk, number)
+            results.append(dict(name=f"startup/load-{fmt}/{nvars}", ms=elapsed * 1e3, us_per_var=elapsed * 1e6 / nvars,
+                                speedup=legacy / elapsed))
+    return results
+
+
+def timed_once(fn, repeat=3):
+    "Best-of-repeat seconds for one call, for runs too long to loop;"
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def bench_dynafile(sizes=SIZES, seed=SEED):
+    "DynaFile load (read + trim), trim_iter over the result, and streamed / mmapped trim_iter;"
+    rng = random.Random(seed)
+    results = [ ]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for nlines in sizes:
+            fn = make_script(os.path.join(tmpdir, f"script{nlines}.i"), nlines, rng)
+            size = os.path.getsize(fn)
+            load = timed_once(lambda: DynaFile(fn))
+            df = DynaFile(fn)
+            def iterate():
+                df._trim_line_no = 0
+                for ln in df.trim_iter():
+                    pass
+            trim_iter = timed_once(iterate)
+            stream = timed_once(lambda: [ ln for ln in DynaFile(fn, stream=True).trim_iter() ])
+            def mapped():
+                mdf = DynaFile(fn, mmap=True)
+                lines = [ ln for ln in mdf.trim_iter() ]
+                mdf.close()
+                return lines
+            mmapped = timed_once(mapped)
+            results.append(dict(name=f"dynafile/load/{nlines}", ms=load * 1e3, mb_s=size / load / 1e6))
+            results.append(dict(name=f"dynafile/trim_iter/{nlines}", ms=trim_iter * 1e3, lines_s=nlines / trim_iter))
+            results.append(dict(name=f"dynafile/stream/{nlines}", ms=stream * 1e3, mb_s=size / stream / 1e6))
+            results.append(dict(name=f"dynafile/mmap/{nlines}", ms=mmapped * 1e3, mb_s=size / mmapped / 1e6))
+            fn = make_continued(os.path.join(tmpdir, f"continued{nlines}.i"), nlines, rng)
+            continued = timed_once(lambda: DynaFile(fn, continuation="\\"))
+            results.append(dict(name=f"dynafile/continued/{nlines}", ms=continued * 1e3,
+                                mb_s=os.path.getsize(fn) / continued / 1e6))
+    return results
+
+
+def bench_includes(seed=SEED, depth=4, fanout=4, nlines=200):
+    "Loading a deep include tree: cold (include caches cleared) and warm, eager and prefetched;"
+    rng = random.Random(seed)
+    results = [ ]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = make_include_tree(tmpdir, depth, fanout, nlines, rng)
+        nfiles = sum(fanout ** level for level in range(depth + 1))
+        kwa = dict(include_directive='include', search_dirs=[ tmpdir ])
+        def cold(**extra):
+            DynaFile._include_cache.clear()
+            DynaFile._resolver.clear()
+            return DynaFile(root, **kwa, **extra)
+        nout = len(cold().trimmed)
+        for name, fn in [ ( "cold", cold ), ( "warm", lambda: DynaFile(root, **kwa) ),
+                          ( "cold-prefetch", lambda: cold(prefetch=True) ) ]:
+            elapsed = timed_once(fn)
+            results.append(dict(name=f"includes/{name}/{nfiles}files", ms=elapsed * 1e3, lines_s=nout / elapsed))
+    return results
+
+
+def bench_insert(sizes=SIZES, seed=SEED, inserts=1000):
+    "insert_trimmed of small pieces at random positions into a loaded DynaFile;"
+    rng = random.Random(seed)
+    results = [ ]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for nlines in sizes:
+            fn = make_script(os.path.join(tmpdir, f"script{nlines}.i"), nlines, rng)
+            piece = [ f"echo inserted {n}" for n in range(5) ]
+            positions = [ rng.random() for n in range(inserts) ]
+            def insert():
+                df = DynaFile(fn)
+                began = time.perf_counter()
+                for pos in positions:
+                    df.insert_trimmed(piece, int(pos * len(df.trimmed)), exclude_source_lines=0)
+                return time.perf_counter() - began
+            elapsed = min(insert() for n in range(3))
+            results.append(dict(name=f"insert_trimmed/{nlines}", ms=elapsed * 1e3, us_per_insert=elapsed * 1e6 / inserts))
+    return results
+
+
+def bench_expand(number=2000, seed=SEED):
+    "Expander.expand and expand_tokens on templates heavy in each reference syntax, and namespaced lookups;"
+    rng = random.Random(seed)
+    xp = make_expander()
+    kinds = dict(simple="{{v{n}}}", namespaced="{{ns:v{n}}}", fielded="{{f{n}.x}}", deep="{{ns:f{n}.x}}",
+                 length="{{~v{n}}}", mixed=None)
+    results = [ ]
+    for kind, pattern in kinds.items():
+        if pattern is None:
+            line = make_line(20)
+        else:
+            line = "echo " + " ".join(pattern.format(n=rng.randrange(10)) + "-x" for n in range(20))
+        tokens = xp.tokenize(line)
+        expand = timed(lambda: xp.expand(line), number)
+        expand_tokens = timed(lambda: xp.expand_tokens(*tokens), number)
+        results.append(dict(name=f"expand/{kind}/20refs", expand_us=expand * 1e6, expand_tokens_us=expand_tokens * 1e6))
+    keys = [ "v3", "ns:v3", "f3.x", "ns:f3.x", "~ns:v3", "ns:missing" ]
+    for key in keys:
+        lookup = timed(lambda: xp.get(key), number * 10)
+        results.append(dict(name=f"lookup/{key}", us=lookup * 1e6))
+    return results
+
+
+def bench_fixer_script(sizes=SIZES, seed=SEED):
+    "Fixer.__call__ over every line of a synthetic script;"
+    rng = random.Random(seed)
+    fixer = Fixer(safe=True, **{ f"v{n}": f"value-{n}" for n in range(10) })
+    results = [ ]
+    for nlines in sizes:
+        lines = [ " ".join(rng.choice([ "word", "{v%d}" % rng.randrange(10), "{x1 * %d}" % rng.randrange(9) ])
+                           for n in range(8)) for n in range(nlines) ]
+        elapsed = timed_once(lambda: [ fixer(ln) for ln in lines ])
+        results.append(dict(name=f"fixer/script/{nlines}", ms=elapsed * 1e3, lines_s=nlines / elapsed))
+    return results
+
+
+BENCHES = dict(scanner=bench_scanner, tokenizer=bench_tokenizer, recursive=bench_recursive, startup=bench_startup,
+               fixer=bench_fixer, dynafile=bench_dynafile, includes=bench_includes, insert=bench_insert,
+               expand=bench_expand, fixer_script=bench_fixer_script)
+
+
+def run(names, **opts):
+    "Results of the named benches, passing each the opts its signature takes;"
+    results = [ ]
+    for name in names:
+        fn = BENCHES[name]
+        params = inspect.signature(fn).parameters
+        results.extend(fn(**{ k: v for k, v in opts.items() if k in params }))
+    return results
+
+
+def meta(**opts):
+    "Where and on what a run happened, so saved results can be compared;"
+    try:
+        commit = subprocess.run([ "git", "rev-parse", "--short", "HEAD" ], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return dict(commit=commit, python=platform.python_version(), platform=platform.platform(),
+                time=time.strftime("%Y-%m-%dT%H:%M:%S"), **opts)
+
+
+def compare(old, new):
+    "( name, metric, old, new, new / old ) for every metric both runs measured;"
+    before = { result['name']: result for result in old['results'] }
+    rows = [ ]
+    for result in new['results']:
+        prior = before.get(result['name'], { })
+        for k, v in result.items():
+            if k != 'name' and isinstance(prior.get(k), ( int, float )) and prior[k]:
+                rows.append(( result['name'], k, prior[k], v, v / prior[k] ))
+    return rows
+
+
+if __name__ == "__main__":
+    def main(args):
+        opts, names, json_fn, compare_fn = dict(seed=SEED, sizes=SIZES), [ ], None, None
+        while args:
+            arg = args.pop(0)
+            if arg == '--lines':
+                opts['sizes'] = tuple(int(n) for n in args.pop(0).split(","))
+            elif arg == '--seed':
+                opts['seed'] = int(args.pop(0))
+            elif arg == '--json':
+                json_fn = args.pop(0)
+            elif arg == '--compare':
+                compare_fn = args.pop(0)
+            elif arg in BENCHES:
+                names.append(arg)
+            else:
+                print(f"Unknown bench or option {arg}; benches: {', '.join(BENCHES)}\n{__doc__}")
+                return 1
+        results = run(names or list(BENCHES), **opts)
+        report = dict(meta=meta(**opts), results=results)
+        if json_fn == '-':
+            json.dump(report, sys.stdout, indent=1)
+            print()
+        else:
+            for result in results:
+                fields = "  ".join(f"{k}={v:.2f}" for k, v in result.items() if k != 'name')
+                print(f"{result['name']:<32} {fields}")
+            if json_fn:
+                with open(json_fn, 'w') as ofd:
+                    json.dump(report, ofd, indent=1)
+        if compare_fn:
+            with open(compare_fn, 'r') as ifd:
+                old = json.load(ifd)
+            print(f"\nagainst {old['meta'].get('commit')} ({compare_fn}):")
+            for name, metric, before, after, ratio in compare(old, report):
+                print(f"{name:<32} {metric:<18} {before:12.2f} -> {after:12.2f}  x{ratio:.2f}")
+        return 0
+
+    pname, *args = sys.argv[:]
+    sys.exit(main(args))
@@ -1,23 +1,207 @@
 #!/bin/env python3
 
 if True:
+    import ast
+    import functools
+    import glob
+    import itertools
+    import operator
     import os
     import re
+    import shutil
+    import tempfile
+    import threading
+    import time
+    from   concurrent.futures import ProcessPoolExecutor
+    from   collections import ChainMap, OrderedDict
+    try:
+        from   .dizzle import Budget, Expander
+    except ImportError:
+        from   dizzle import Budget, Expander
+
+
+EXPR_CACHE_SIZE = 1024
+_WORDS_REX = re.compile(r'\s+')
+SAFE_MAX_POWER = 1024           # Largest integer exponent a safe expression may use;
+SAFE_MAX_REPEAT = 1 << 20       # Longest str/list a safe expression may build by multiplying;
+SAFE_MAX_BITS = 1 << 16         # Largest int (in bits) a safe ** or * may produce, so nesting them can't blow up;
+
+_SAFE_BINOPS = { ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+                 ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod, ast.Pow: operator.pow }
+_SAFE_UNARYOPS = { ast.UAdd: operator.pos, ast.USub: operator.neg, ast.Not: operator.not_ }
+_SAFE_COMPARES = { ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt, ast.LtE: operator.le,
+                   ast.Gt: operator.gt, ast.GtE: operator.ge, ast.In: lambda a, b: a in b,
+                   ast.NotIn: lambda a, b: a not in b }
+_SAFE_CALLS = dict(abs=abs, float=float, int=int, len=len, max=max, min=min, round=round, str=str)
+
+
+def _safe_binop(op, left, right):
+    "op(left, right), refusing the results that could exhaust memory or time;"
+    if op is operator.pow and isinstance(right, int) and abs(right) > SAFE_MAX_POWER:
+        raise ValueError(f"Fixer: Exponent {right} is over SAFE_MAX_POWER={SAFE_MAX_POWER}")
+    if isinstance(left, int) and isinstance(right, int):
+        # Bound the result before computing it: a ** b takes about bits(a) * b bits, a * b bits(a) + bits(b);
+        if op is operator.pow:
+            bits = left.bit_length() * right if right > 0 else 0
+        elif op is operator.mul:
+            bits = left.bit_length() + right.bit_length()
+        else:
+            bits = 0
+        if bits > SAFE_MAX_BITS:
+            raise ValueError(f"Fixer: Result would be over SAFE_MAX_BITS={SAFE_MAX_BITS} bits")
+    if op is operator.mod and isinstance(left, ( str, bytes )):
+        # printf-style formatting: a width or precision like %0200000000d builds a string of any size;
+        raise ValueError("Fixer: % formatting of strings isn't allowed in safe expressions")
+    if op is operator.mul:
+        for seq, n in [ ( left, right ), ( right, left ) ]:
+            if isinstance(seq, ( str, list, tuple )) and isinstance(n, int) and len(seq) * n > SAFE_MAX_REPEAT:
+                raise ValueError(f"Fixer: Repeating a sequence past SAFE_MAX_REPEAT={SAFE_MAX_REPEAT}")
+    return op(left, right)
+
+
+def _safe_compile(node):
+    "Turn an expression's AST into nested closures taking the bound variables; only arithmetic-ish nodes pass;"
+    where = "Fixer._safe_compile"
+    if isinstance(node, ast.Constant):
+        value = node.value
+        return lambda env: value
+    if isinstance(node, ast.Name):
+        name = node.id
+        def lookup(env):
+            if name not in env:
+                raise NameError(f"{where}: name '{name}' is not a Fixer var")
+            return env[name]
+        return lookup
+    if isinstance(node, ast.BinOp) and type(node.op) in _SAFE_BINOPS:
+        op, left, right = _SAFE_BINOPS[type(node.op)], _safe_compile(node.left), _safe_compile(node.right)
+        if op in ( operator.pow, operator.mul, operator.mod ):
+            return lambda env: _safe_binop(op, left(env), right(env))
+        return lambda env: op(left(env), right(env))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _SAFE_UNARYOPS:
+        op, operand = _SAFE_UNARYOPS[type(node.op)], _safe_compile(node.operand)
+        return lambda env: op(operand(env))
+    if isinstance(node, ast.BoolOp):
+        values = [ _safe_compile(value) for value in node.values ]
+        if isinstance(node.op, ast.And):
+            def and_(env):
+                for value in values:
+                    result = value(env)
+                    if not result:
+                        return result
+                return result
+            return and_
+        def or_(env):
+            for value in values:
+                result = value(env)
+                if result:
+                    return result
+            return result
+        return or_
+    if isinstance(node, ast.Compare) and all(type(op) in _SAFE_COMPARES for op in node.ops):
+        left = _safe_compile(node.left)
+        chain = [ ( _SAFE_COMPARES[type(op)], _safe_compile(right) ) for op, right in zip(node.ops, node.comparators) ]
+        def compare(env):
+            a = left(env)
+            for op, right in chain:
+                b = right(env)
+                if not op(a, b):
+                    return False
+                a = b
+            return True
+        return compare
+    if isinstance(node, ast.IfExp):
+        test, body, orelse = _safe_compile(node.test), _safe_compile(node.body), _safe_compile(node.orelse)
+        return lambda env: body(env) if test(env) else orelse(env)
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _SAFE_CALLS \
+            and not node.keywords:
+        fn, args = _SAFE_CALLS[node.func.id], [ _safe_compile(arg) for arg in node.args ]
+        return lambda env: fn(*[ arg(env) for arg in args ])
+    raise ValueError(f"{where}: {type(node).__name__} isn't allowed in a safe expression")
+
+
+@functools.lru_cache(maxsize=EXPR_CACHE_SIZE)
+def _compile_expr(text, safe):
+    "( evaluator taking the bound names, names it reads, syntax tree depth ) for an expression, cached;"
+    tree = ast.parse(text.strip(), mode='eval')
+    names = tuple(sorted({ node.id for node in ast.walk(tree) if isinstance(node, ast.Name) }))
+    if safe:
+        evaluator = _safe_compile(tree.body)
+    else:
+        code = compile(tree, "<Fixer>", 'eval')
+        evaluator = lambda env: eval(code, { }, env)
+    return evaluator, names, _depth(tree.body)
+
+
+def _depth(node):
+    "Nesting depth of a syntax tree;"
+    return 1 + max(( _depth(child) for child in ast.iter_child_nodes(node) ), default=0)
+
+
+@functools.lru_cache(maxsize=EXPR_CACHE_SIZE)
+def _literal(value):
+    "A var's text as the Python literal it spells (\"10\" is 10), else the text itself;"
+    try:
+        return ast.literal_eval(value.strip())
+    except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+        return value
+
+
+class VarsCache():
+    "Process-wide cache of parsed vars files, keyed on ( absolute path, mtime, size ); the dicts are shared, read-only;"
+    def __init__(self, maxsize = 64):
+        self._maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+        return
+
+    def load(self, fn, force = False):
+        "Parsed vars of fn, re-read when its mtime or size changed (or force);"
+        path = os.path.abspath(fn)
+        st = os.stat(path)
+        key = ( path, st.st_mtime_ns, st.st_size )
+        with self._lock:
+            entry = None if force else self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        entry = Expander.read_vars(path)
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
 
 
 class Fixer:
-    def __init__(self, start = None, end = None, unsafe=False, **vars):
-        self._vars = { **vars, **self._load() }
+    _vars_cache = VarsCache()
+
+    def __init__(self, start = None, end = None, unsafe=False, limits=None, safe=False, vars_file=None, **vars):
+        # vars_file: a path, or a list of paths where later files win; None reads ./.vars if there is one;
+        self._vars_files = [ vars_file ] if isinstance(vars_file, str) else vars_file
+        self._kwvars = vars
+        self.reload(force=False)
         self._unsafe = unsafe   # This risks eval-injections;
+        self._safe = safe       # Arithmetic, comparisons and a few builtins, through the restricted evaluator;
+        self._limits = limits   # An ExpansionLimits, checked between substitutions (not inside an eval);
         if start == None:
             start = "{"
         if end == None:
             end = "}"
         self._start, self._end = start, end
-        pat = rf"(?P<full>{start}(?P<var>\w+){end})"
+        # One pass for both: a bare {name} is a var, anything else between the delimiters an expression;
+        pat = rf"{re.escape(start)}(?:(?P<var>\w+)|(?P<words>.*?)){re.escape(end)}"
         self._rex = re.compile(pat)
-        expr_pat = rf"(?P<full>{start}(?P<words>.*?){end})"
-        self._expr_rex = re.compile(expr_pat)
 
     def __getitem__(self, k):
         return self._vars[k]
@@ -30,31 +214,42 @@ class Fixer:
         if not self._has_stuff(s):
             self._dest = None
             return s
-        tups = self._rex.findall(s)
-        for tup in tups:
-            full, k = tup
-            s = s.replace(full, self[k])
-        if not self._has_stuff(s):
-            self._dest = s
-            return s
-
-        # Expression support
-        tups = self._expr_rex.findall(s)
-        for tup in tups:
-            full, words = tup
-            particles = [ ]
-            for word in re.split(r'\s+', words):
-                if word in self:
-                    particles.append(self[word])
-                else:
-                    particles.append(word)
-            departicled = " ".join(particles)
-            if self._unsafe:
-                departicled = str(eval(departicled))
-            s = s.replace(full, departicled)
+        budget = Budget(self._limits, "Fixer.__call__") if self._limits else None
+        values = { }        # Repeated references are only looked up (or evaluated) once per call;
+        growth = 0          # How much longer than s the output is so far, for the budget;
+        def fix(mtch):
+            nonlocal growth
+            full, var = mtch.group(0, 'var')
+            name = var if var is not None else mtch.group('words')
+            v = values.get(full)
+            if v is None:
+                v = values[full] = self[var] if var is not None else self._expression(name, budget, len(s) + growth)
+            if budget is not None:
+                growth += len(v) - len(full)
+                budget.charge(name, len(s) + growth)
+            return v
+        s = self._rex.sub(fix, s)
         self._dest = s
         return s
 
+    def _expression(self, words, budget, length):
+        "What {words} becomes: its value (safe or unsafe), else words with any var names swapped for values;"
+        if self._safe or self._unsafe:
+            return str(self.evaluate(words, budget, length))
+        return " ".join(self[word] if word in self else word for word in _WORDS_REX.split(words))
+
+    def evaluate(self, expr, budget = None, length = 0):
+        "Value of expr with the Fixer vars bound by name; the compile step is cached per expression text;"
+        evaluator, names, depth = _compile_expr(expr, not self._unsafe)
+        if budget is not None:
+            budget.charge(expr, length, depth, count=0)
+        vars_ = self._vars
+        return evaluator({ name: _literal(vars_[name]) for name in names if name in vars_ })
+
+    @staticmethod
+    def expr_cache_info():
+        return _compile_expr.cache_info()
+
     def _has_stuff(self, s):
         if self._start not in s:
             return False
@@ -65,13 +260,17 @@ class Fixer:
             return False
         return True
 
-    def _load(self, fn = ".vars"):
-        if not os.path.isfile(fn):
+    def _load(self, fn = ".vars", force = False):
+        if self._vars_files is None and not os.path.isfile(fn):
             return dict()
-        with open(fn, 'r') as ifd:
-            ibuf = [ln.strip() for ln in ifd.readlines()]
-            tupdict = dict([re.split(r'\s+', ln, 1) for ln in ibuf])
-        return tupdict
+        return Fixer._vars_cache.load(fn, force)
+
+    def reload(self, force = True):
+        "(Re)read the vars files, by default even when their mtime and size haven't changed;"
+        layers = [ self._load(fn, force) for fn in (self._vars_files or [ ".vars" ]) ]
+        # Writes land in the first (own) dict, never in the shared parsed files; files win over keyword vars;
+        self._vars = ChainMap({ }, *reversed(layers), self._kwvars)
+        return self
 
     @property
     def dest(self):
@@ -86,12 +285,115 @@ class Fixer:
         return self._source
 
 
+def bulk_targets(targets):
+    """( file, path relative to its target ) for every file targets (files, directories walked recursively,
+    or globs) name, in order, each once;
+    """
+    seen, files = set(), [ ]
+    for target in targets:
+        if os.path.isdir(target):
+            root = target
+            found = sorted(os.path.join(dirnm, fn) for dirnm, subdirs, fns in os.walk(target) for fn in fns)
+        elif glob.has_magic(target):
+            # The root is the directory before the first wildcard component;
+            parts = target.split(os.sep)
+            fixed = list(itertools.takewhile(lambda part: not glob.has_magic(part), parts))
+            root = os.sep.join(fixed) or "."
+            found = sorted(fn for fn in glob.glob(target, recursive=True) if os.path.isfile(fn))
+        else:
+            root, found = os.path.dirname(target), [ target ]
+        for fn in found:
+            if fn not in seen:
+                seen.add(fn)
+                files.append(( fn, os.path.relpath(fn, root or ".") ))
+    return files
+
+
+def fix_file(src, dst = None, **fixer_kwa):
+    """Stream src through a Fixer line by line into dst (default: src itself), replacing dst atomically;
+
+    Returns a result dict; on an error dst is left untouched and the error is reported in the result;
+    """
+    dst = dst or src
+    result = dict(src=src, dst=dst, lines=0, changed=0, bytes_in=0, bytes_out=0, error=None)
+    began, tmp = time.perf_counter(), None
+    try:
+        fixer = Fixer(**fixer_kwa)
+        dirnm = os.path.dirname(os.path.abspath(dst))
+        os.makedirs(dirnm, exist_ok=True)
+        with open(src, 'r', newline='') as ifd, \
+             tempfile.NamedTemporaryFile('w', dir=dirnm, prefix=".fix-", delete=False, newline='') as ofd:
+            tmp = ofd.name
+            encoding = ifd.encoding
+            for ln in ifd:
+                fixed = fixer(ln)
+                result['lines'] += 1
+                result['changed'] += fixed != ln
+                result['bytes_in'] += len(ln.encode(encoding))  # Bytes, not characters, for the MB/s figures;
+                result['bytes_out'] += len(fixed.encode(encoding))
+                ofd.write(fixed)
+        shutil.copymode(src, tmp)
+        os.replace(tmp, dst)
+        tmp = None
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    finally:
+        if tmp is not None:
+            os.unlink(tmp)
+    result['seconds'] = time.perf_counter() - began
+    return result
+
+
+def _fix_file_job(job):
+    src, dst, fixer_kwa = job
+    return fix_file(src, dst, **fixer_kwa)
+
+
+def fix_files(targets, out_dir = None, max_workers = None, **fixer_kwa):
+    """fix_file() every file bulk_targets(targets) finds, across a process pool (default: one per CPU);
+
+    out_dir mirrors each file (relative to its target) under it, instead of rewriting it in place.  Files that
+    would be written to the same destination (eg: a/x.cfg and b/x.cfg into one out_dir) aren't fixed, each gets
+    an error result instead.  Returns ( per-file results in target order, summary with files/s and MB/s );
+    """
+    began = time.perf_counter()
+    files = bulk_targets(targets)
+    jobs = [ ( fn, os.path.join(out_dir, rel) if out_dir else None, fixer_kwa ) for fn, rel in files ]
+    writers = { }   # realpath of each destination -> the files that would write it;
+    for fn, dst, kwa in jobs:
+        writers.setdefault(os.path.realpath(dst or fn), [ ]).append(fn)
+    results = [ None ] * len(jobs)
+    for i, ( fn, dst, kwa ) in enumerate(jobs):
+        clashes = writers[os.path.realpath(dst or fn)]
+        if len(clashes) > 1:
+            others = ", ".join(other for other in clashes if other != fn)
+            results[i] = dict(src=fn, dst=dst or fn, lines=0, changed=0, bytes_in=0, bytes_out=0, seconds=0.0,
+                              error=f"DuplicateDestination: {dst or fn} would also be written from {others}")
+    todo = [ i for i, result in enumerate(results) if result is None ]
+    max_workers = max_workers or os.cpu_count() or 1
+    if max_workers == 1 or len(todo) < 2:
+        done = [ _fix_file_job(jobs[i]) for i in todo ]
+    else:
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(todo))) as pool:
+            chunksize = max(1, len(todo) // (max_workers * 4))
+            done = list(pool.map(_fix_file_job, [ jobs[i] for i in todo ], chunksize=chunksize))
+    for i, result in zip(todo, done):
+        results[i] = result
+    seconds = max(time.perf_counter() - began, 1e-9)
+    nbytes = sum(result['bytes_in'] for result in results)
+    summary = dict(files=len(results), errors=sum(1 for result in results if result['error']),
+                   lines=sum(result['lines'] for result in results), bytes=nbytes, seconds=seconds,
+                   files_per_s=len(results) / seconds, mb_per_s=nbytes / seconds / 1e6, workers=max_workers)
+    return results, summary
+
+
 if __name__ == "__main__":
     from   pprint import pprint
     import sys
+    from   dizzle import ExpansionLimitError, ExpansionLimits
 
 
-   def main(args):
+    def main(args):
         start, end = "{{", "}}"
         if len(args) == 1:
             s = args.pop(0)
@@ -109,7 +411,7 @@ if __name__ == "__main__":
         fixer = Fixer(start, end, unsafe=True)
         fixed = fixer(s)
         print(f"{fixer.source} --> {fixer.dest}")
-        print(fixer.vars)
+        print(dict(fixer.vars))
 
     # If we make the var term more liberal (via |) can we parse words out of var,
     # and if they are not in vars simply leave them un-replaced;
@@ -126,10 +428,156 @@ if __name__ == "__main__":
             fixer = Fixer(unsafe = test.get('unsafe', False))
             fixed = fixer(test['s'])
             print(f"{fixer.source} --> {fixer.dest}")
+        test_limits()
+        test_expressions()
+        test_vars_cache()
+        test_bulk()
+
+    def test_bulk():
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tree = os.path.join(tmpdir, "tree")
+            for n in range(12):
+                os.makedirs(os.path.join(tree, f"d{n % 3}"), exist_ok=True)
+                with open(os.path.join(tree, f"d{n % 3}", f"f{n:02d}.cfg"), 'w') as ofd:
+                    ofd.write(f"name = {{a}}-{n}\r\nsize = {{x1 * {n}}}\nplain line\n")
+            with open(os.path.join(tree, "bad.cfg"), 'w') as ofd:
+                ofd.write("ok {a}\nbroken {nope}\n")
+            out = os.path.join(tmpdir, "out")
+            results, summary = fix_files([ tree, os.path.join(tree, "d1", "*.cfg") ], out_dir=out, max_workers=2,
+                                         safe=True)
+            assert [ result['src'] for result in results ] == [ fn for fn, rel in bulk_targets([ tree ]) ]
+            assert summary['files'] == 13
+            assert summary['errors'] == 1 and results[0]['error'].startswith("KeyError")
+            with open(os.path.join(out, "d2", "f05.cfg"), newline='') as ifd:
+                assert ifd.read() == "name = Eh?-5\r\nsize = 50\nplain line\n"
+            assert not os.path.exists(os.path.join(out, "bad.cfg"))
+            in_place = os.path.join(tree, "d0", "f00.cfg")
+            results, summary = fix_files([ in_place, os.path.join(tree, "bad.cfg") ], max_workers=1)
+            with open(in_place) as ifd:
+                assert ifd.read().startswith("name = Eh?-0")
+            assert not [ fn for fn in os.listdir(os.path.join(tree, "d0")) if fn.startswith(".fix-") ]
+            with open(os.path.join(tree, "bad.cfg")) as ifd:
+                assert ifd.read() == "ok {a}\nbroken {nope}\n"  # Failed files are left untouched;
+            assert summary['files_per_s'] > 0 and summary['mb_per_s'] > 0
+            clash = os.path.join(tmpdir, "clash")
+            results, summary = fix_files([ os.path.join(tree, "d0", "f03.cfg"), os.path.join(tree, "d1", "f04.cfg"),
+                                           os.path.join(tree, "d0", "f00.cfg"), os.path.join(out, "d0", "f00.cfg") ],
+                                         out_dir=clash, max_workers=2)
+            assert summary['errors'] == 2 and [ bool(result['error']) for result in results ] == [ False ] * 2 + [ True ] * 2
+            assert results[2]['error'].startswith("DuplicateDestination") and not os.path.exists(os.path.join(clash, "f00.cfg"))
+            accented = os.path.join(tmpdir, "accented.cfg")
+            with open(accented, 'w') as ofd:
+                ofd.write("café {a}\nnaïve\n")
+            size = os.path.getsize(accented)
+            results, summary = fix_files([ accented ], max_workers=1)
+            assert results[0]['bytes_in'] == summary['bytes'] == size and results[0]['bytes_out'] == size, results
+            assert bulk_main([ '--jobs', 'many', accented ]) == 1 and bulk_main([ '--jobs', '0', accented ]) == 1
+        print("test_bulk: ok")
+
+    def test_vars_cache():
+        with tempfile.TemporaryDirectory() as tmpdir:
+            base, site = os.path.join(tmpdir, "base.vars"), os.path.join(tmpdir, "site.vars")
+            with open(base, 'w') as ofd:
+                ofd.write("a\tbase-a\nb\tbase-b\n")
+            with open(site, 'w') as ofd:
+                ofd.write("b\tsite-b\n")
+            misses = Fixer._vars_cache.misses
+            fixer = Fixer(vars_file=[ base, site ], c="kw-c")
+            assert fixer("{a} {b} {c}") == "base-a site-b kw-c"
+            hits = Fixer._vars_cache.hits
+            for n in range(50):
+                assert Fixer(vars_file=base)("{b}") == "base-b"
+            assert Fixer._vars_cache.hits == hits + 50 and Fixer._vars_cache.misses == misses + 2
+            fixer.vars['a'] = "own"                 # Lands in the Fixer's own layer, not the shared parse;
+            assert fixer("{a}") == "own" and Fixer(vars_file=base)("{a}") == "base-a"
+            with open(site, 'w') as ofd:
+                ofd.write("b\tnew-site-b\n")      # A new size, so the next lookup re-reads it;
+            assert Fixer(vars_file=[ base, site ])("{b}") == "new-site-b" and fixer("{b}") == "site-b"
+            assert fixer.reload()("{b} {a}") == "new-site-b base-a"
+            try:
+                Fixer(vars_file=os.path.join(tmpdir, "missing.vars"))
+                assert False, "missing vars file not reported"
+            except FileNotFoundError:
+                pass
+        print("test_vars_cache: ok")
+
+    def test_expressions():
+        safe, unsafe = Fixer(safe=True), Fixer(unsafe=True)
+        for expr in [ "x1 / x2", "x1 * 3 + x2 ** 2", "-x1 // 3 % 4", "x1 > x2 and x2 >= 5", "max(x1, x2, 7)",
+                      "x1 if x1 < x2 else x2", "len(a) == 3", "1 < x2 < x1", "str(x1) + 'px'" ]:
+            assert safe.evaluate(expr) == unsafe.evaluate(expr), expr
+        assert safe("{x1 / x2}|{a}") == "2.0|Eh?" and safe("{x1 + 1}") == "11"
+        for bad in [ "__import__('os')", "a.upper()", "(lambda: 1)()", "[ c for c in a ]", "2 ** 100000", "'x' * 2 ** 30",
+                     "((2 ** 1024) ** 1024) ** 1024", "(2 ** 1000) ** 60 * (2 ** 1000) ** 60",
+                     "'%0200000000d' % 1", "'%.150000000f' % 1.0", "a % x1" ]:
+            try:
+                safe.evaluate(bad)
+                assert False, f"safe mode ran {bad}"
+            except ValueError:
+                pass
+        hits = Fixer.expr_cache_info().hits
+        for n in range(100):
+            assert safe("{x1 * x2}") == "50"
+        assert Fixer.expr_cache_info().hits >= hits + 99   # Only the first call compiles;
+        print("test_expressions: ok")
+
+    def test_limits():
+        limited = dict(max_output=40, max_substitutions=4, max_depth=4, time_budget=60)
+        for limit, s in [ ( 'max_output', "{e}, {e}, {e}, {e}!" ), ( 'max_substitutions', "{a} {a} {b} {c} {d}" ),
+                          ( 'max_depth', "{- ( - ( - ( - ( - x1 ) ) ) )}" ) ]:
+            fixer = Fixer(unsafe=True, limits=ExpansionLimits(**limited))
+            try:
+                fixer(s)
+                assert False, f"{limit} not enforced on {s}"
+            except ExpansionLimitError as e:
+                assert e.limit == limit, e
+        fixer = Fixer(unsafe=True, limits=ExpansionLimits(**limited))
+        assert fixer("{a}-{x1 / x2}") == f"{fixer['a']}-2.0"
+        print("test_limits: ok")
+
+    def bulk_main(args):
+        "bulk [--out DIR] [--jobs N] [--start S] [--end E] [--vars FILE]... [--safe|--unsafe] target...;"
+        fixer_kwa, out_dir, jobs, vars_files, targets = dict(), None, None, [ ], [ ]
+        while args:
+            arg = args.pop(0)
+            if arg in [ '--out', '--jobs', '--start', '--end', '--vars' ] and not args:
+                print(f"bulk: {arg} needs a value")
+                return 1
+            if arg == '--out':
+                out_dir = args.pop(0)
+            elif arg == '--jobs':
+                jobs = args.pop(0)
+                if not jobs.isdigit() or int(jobs) < 1:
+                    print(f"bulk: --jobs needs a positive number of workers, not {jobs}\n{bulk_main.__doc__}")
+                    return 1
+                jobs = int(jobs)
+            elif arg in [ '--start', '--end' ]:
+                fixer_kwa[arg[2:]] = args.pop(0)
+            elif arg == '--vars':
+                vars_files.append(args.pop(0))
+            elif arg in [ '--safe', '--unsafe' ]:
+                fixer_kwa[arg[2:]] = True
+            else:
+                targets.append(arg)
+        if not targets:
+            print(bulk_main.__doc__)
+            return 1
+        if vars_files:
+            fixer_kwa['vars_file'] = vars_files
+        results, summary = fix_files(targets, out_dir=out_dir, max_workers=jobs, **fixer_kwa)
+        for result in results:
+            status = result['error'] or f"{result['changed']}/{result['lines']} lines changed"
+            print(f"{result['src']} -> {result['dst']}: {status}")
+        print(f"{summary['files']} files ({summary['errors']} errors), {summary['lines']} lines, "
+              f"{summary['bytes'] / 1e6:.2f} MB in {summary['seconds']:.3f}s with {summary['workers']} workers: "
+              f"{summary['files_per_s']:.1f} files/s, {summary['mb_per_s']:.2f} MB/s")
+        return 1 if summary['errors'] else 0
 
     pname, *args = sys.argv[:]
     if args and args[0].lower() == 'test':
         test_master(args)
+    elif args and args[0].lower() == 'bulk':
+        sys.exit(bulk_main(args[1:]))
     else:
         main(args)
     sys.exit(0)